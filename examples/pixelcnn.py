@@ -1,7 +1,8 @@
 # Run this example in your browser: https://colab.research.google.com/drive/1DMRbUPAxTlk0Awf3D_HR3Oz3P3MBahaJ
+import time
 from pathlib import Path
 
-from jax import np, onp, lax, random, vmap
+from jax import np, onp, lax, random, vmap, jit
 from jax.experimental.optimizers import exponential_decay
 from jax.nn import elu, sigmoid, softplus
 from jax.nn.initializers import normal
@@ -9,7 +10,8 @@ from jax.random import PRNGKey
 from jax.scipy.special import logsumexp
 from jax.util import partial
 
-from jaxnet import parametrized, Parameter, Dropout, parameter, save
+from jaxnet import parametrized, Parameter, Dropout, parameter, save, ResizeConv, SubpixelConv, \
+    ConvTranspose as PlainConvTranspose
 from jaxnet.optimizers import Adam
 
 image_dtype = np.uint8
@@ -43,6 +45,31 @@ def ConvOrConvTranspose(out_chan, filter_shape=(3, 3), strides=None, padding='SA
 
         return apply(inputs, V, b, g)
 
+    (f_h, _), (s_h, _) = filter_shape, strides
+
+    def rows(params, inputs, start, count):
+        """Computes output rows `start` to `start + count` (`start` may be traced) of
+        `conv_or_conv_transpose` from only the input rows they depend on."""
+        if transpose:
+            if padding != 'VALID' or f_h != s_h:
+                raise ValueError('Transposed row evaluation requires VALID padding and '
+                                 'filter height equal to stride height.')
+            # each output row depends only on input row `row // s_h`:
+            size = min((count - 1) // s_h + 2, inputs.shape[1])
+            first = np.clip(start // s_h, 0, inputs.shape[1] - size)
+            offset = start - first * s_h
+        else:
+            if padding != 'VALID' and (f_h, s_h) != (1, 1):
+                raise ValueError('Row evaluation requires VALID padding or 1x1 filters.')
+            size = (count - 1) * s_h + f_h
+            first = start * s_h
+            offset = 0
+
+        band = lax.dynamic_slice_in_dim(inputs, first, size, axis=1)
+        outputs = conv_or_conv_transpose.apply(params, band)
+        return lax.dynamic_slice_in_dim(outputs, offset, count, axis=1)
+
+    conv_or_conv_transpose.rows = rows
     return conv_or_conv_transpose
 
 
@@ -58,7 +85,7 @@ def concat_elu(x, axis=-1):
     return elu(np.concatenate((x, -x), axis))
 
 
-def GatedResnet(Conv=None, nonlinearity=concat_elu, dropout_p=0.):
+def GatedResnet(Conv=None, nonlinearity=concat_elu, dropout_p=0., test_mode=False):
     @parametrized
     def gated_resnet(inputs, aux=None):
         chan = inputs.shape[-1]
@@ -67,7 +94,7 @@ def GatedResnet(Conv=None, nonlinearity=concat_elu, dropout_p=0.):
             c1 = c1 + NIN(chan)(nonlinearity(aux))
         c1 = nonlinearity(c1)
         if dropout_p > 0:
-            c1 = Dropout(rate=dropout_p)(c1)
+            c1 = Dropout(rate=dropout_p, test_mode=test_mode)(c1)
         c2 = Conv(2 * chan, init_scale=0.1)(c1)
         a, b = np.split(c2, 2, axis=-1)
         c3 = a * sigmoid(b)
@@ -173,13 +200,109 @@ def logprob_from_conditional_params(images, means, inv_scales, logit_probs):
     return np.sum(logsumexp(log_mix_coeffs + all_logprobs, axis=-3), axis=(-2, -1))
 
 
+def sample_from_outputs(theta, key, nr_mix=10):
+    """Samples pixels of shape (batch, 3) in [-1, 1] from model outputs `theta` of shape
+    (batch, 10 * nr_mix), sampling the channels in order, each conditioned on the previous ones."""
+    mixture_key, logistic_key = random.split(key)
+    logit_probs, theta = np.split(theta, [nr_mix], axis=-1)
+    theta = np.swapaxes(np.reshape(theta, theta.shape[:1] + (3, 3 * nr_mix)), 1, 2)
+    means, log_scales, coeffs = np.split(theta, 3, axis=1)
+    mixture = np.argmax(logit_probs + random.gumbel(mixture_key, logit_probs.shape), axis=-1)
+    selected = (np.arange(nr_mix) == mixture[:, None])[..., None]
+    select = lambda x: np.sum(np.where(selected, x, 0), axis=1)
+    mean, inv_scale, coeff = select(means), softplus(select(log_scales)), np.tanh(select(coeffs))
+    u = random.uniform(logistic_key, mean.shape, minval=1e-5, maxval=1. - 1e-5)
+    x = mean + (np.log(u) - np.log(1. - u)) / inv_scale
+    red = np.clip(x[:, 0], -1., 1.)
+    green = np.clip(x[:, 1] + coeff[:, 0] * red, -1., 1.)
+    blue = np.clip(x[:, 2] + coeff[:, 1] * red + coeff[:, 2] * green, -1., 1.)
+    return np.stack((red, green, blue), axis=-1)
+
+
+def sample_naive(network, params, key, shape, nr_mix=10):
+    """Samples images of `shape` (batch, height, width, 3) pixel by pixel in a single compiled
+    `lax.fori_loop`, running `network` on the full image for every new pixel.
+    For comparison with `sample`."""
+    batch, height, width, channels = shape
+
+    def sample_pixel(index, state):
+        images, key = state
+        key, pixel_key = random.split(key)
+        row, column = index // width, index % width
+        theta = network.apply(params, images)
+        theta = lax.dynamic_slice(theta, (0, row, column, 0),
+                                  (batch, 1, 1, theta.shape[-1]))[:, 0, 0]
+        pixel = sample_from_outputs(theta, pixel_key, nr_mix)
+        return lax.dynamic_update_slice(images, pixel[:, None, None], (0, row, column, 0)), key
+
+    images, _ = lax.fori_loop(0, height * width, sample_pixel, (np.zeros(shape), key))
+    return np.array(np.round((images + 1) * 127.5), image_dtype)
+
+
+def sample(network, params, key, shape, nr_mix=10):
+    """Samples images of `shape` (batch, height, width, 3) pixel by pixel in a single compiled
+    `lax.fori_loop`, like `sample_naive`, but caching the outputs of all convolutions.
+    `network` maps centered images to outputs of shape (batch, height, width, 10 * nr_mix),
+    and must be causal, like stacks of down-shifted and down-right-shifted convolutions.
+
+    Output row `r` of a convolution at `1 / f` of the image resolution only depends on
+    image rows up to `f * r + f - 1`. For a pixel in row `row`, each convolution therefore only
+    recomputes its rows `row // f - 1` and `row // f` from the cached outputs of the
+    convolutions before it, while its earlier rows are final and its later rows are not needed.
+    The row above is recomputed to include the last pixel of the previous image row."""
+    batch, height, width, channels = shape
+    images = np.zeros(shape)
+    caches = {}
+
+    def cache_outputs(module, parameters, *inputs, path):
+        outputs = module.apply(parameters, *inputs)
+        if hasattr(module, 'rows'):
+            caches[path] = outputs
+        return outputs
+
+    network.apply(params, images, interceptor=cache_outputs)
+
+    def sample_pixel(index, state):
+        images, caches, key = state
+        key, pixel_key = random.split(key)
+        row, column = index // width, index % width
+        updated_caches = {}
+
+        def update_rows(module, parameters, *inputs, path):
+            if not hasattr(module, 'rows'):
+                return module.apply(parameters, *inputs)
+
+            cache = caches[path]
+            out_height = cache.shape[1]
+            count = min(2, out_height)
+            start = np.clip(row // (height // out_height) - count + 1, 0, out_height - count)
+            rows = module.rows(parameters, *inputs, start, count)
+            updated_caches[path] = lax.dynamic_update_slice_in_dim(cache, rows, start, axis=1)
+            return updated_caches[path]
+
+        theta = network.apply(params, images, interceptor=update_rows)
+        theta = lax.dynamic_slice(theta, (0, row, column, 0),
+                                  (batch, 1, 1, theta.shape[-1]))[:, 0, 0]
+        pixel = sample_from_outputs(theta, pixel_key, nr_mix)
+        images = lax.dynamic_update_slice(images, pixel[:, None, None], (0, row, column, 0))
+        return images, updated_caches, key
+
+    images, _, _ = lax.fori_loop(0, height * width, sample_pixel, (images, caches, key))
+    return np.array(np.round((images + 1) * 127.5), image_dtype)
+
+
 def center(image):
     # TODO fix shapechecking with custom datatype: assert image.dtype == image_dtype
     return image / 127.5 - 1
 
 
-def PixelCNNPP(nr_resnet=5, nr_filters=160, nr_logistic_mix=10, dropout_p=.5):
-    Resnet = partial(GatedResnet, dropout_p=dropout_p)
+def PixelCNNPP(nr_resnet=5, nr_filters=160, nr_logistic_mix=10, dropout_p=.5, test_mode=False):
+    """Returns the loss and the model mapping images to conditional parameters.
+    `pixel_cnn.sample(params, key, shape)` samples images using parameters of `pixel_cnn`,
+    see `sample`, which always disables dropout, building a network in test mode on first use.
+    Use `test_mode=True` to also disable it for `pixel_cnn` and `loss`.
+    `pixel_cnn.network` is the underlying network with the same parameters, as used by `sample`."""
+    Resnet = partial(GatedResnet, dropout_p=dropout_p, test_mode=test_mode)
     ResnetDown = partial(Resnet, Conv=DownShiftedConv)
     ResnetDownRight = partial(Resnet, Conv=DownRightShiftedConv)
 
@@ -246,6 +369,23 @@ def PixelCNNPP(nr_resnet=5, nr_filters=160, nr_logistic_mix=10, dropout_p=.5):
         thetas = down_pass(*up_pass(images))
         return conditional_params_from_outputs(images, thetas)
 
+    @parametrized
+    def network(images):
+        return down_pass(*up_pass(images))
+
+    # network has the same parameter structure as pixel_cnn:
+    pixel_cnn.network = network
+    test_mode_network = []
+
+    def sample_without_dropout(params, key, shape):
+        if not test_mode_network:
+            test_mode_network.append(network if test_mode else PixelCNNPP(
+                nr_resnet, nr_filters, nr_logistic_mix, dropout_p, test_mode=True)[1].network)
+
+        return sample(test_mode_network[0], params, key, shape, nr_mix=nr_logistic_mix)
+
+    pixel_cnn.sample = sample_without_dropout
+
     @parametrized
     def loss(images):
         images = center(images)
@@ -273,6 +413,36 @@ def dataset(batch_size):
     return get_train_batches, test_batches
 
 
+def benchmark_upsampling(batch_size=16, shape=(16, 16), nr_filters=160, filter_shape=(3, 3),
+                         repetitions=20):
+    """Compares FLOPs and latency of upsampling by 2 with `ConvTranspose` and its cheaper
+    alternatives at the same output size. FLOPs are counted as executed, for `ConvTranspose`
+    including multiplications with the zeros inserted between inputs."""
+    height, width = shape
+    inputs = random.uniform(PRNGKey(0), (batch_size, height, width, nr_filters))
+    kernel_flops = 2 * onp.prod(filter_shape) * nr_filters * nr_filters
+    for name, upsampling, flops in (
+            ('ConvTranspose', PlainConvTranspose(nr_filters, filter_shape, (2, 2), 'SAME'),
+             batch_size * 4 * height * width * kernel_flops),
+            ('ResizeConv (nearest)', ResizeConv(nr_filters, filter_shape),
+             batch_size * 4 * height * width * kernel_flops),
+            ('ResizeConv (bilinear)', ResizeConv(nr_filters, filter_shape, method='bilinear'),
+             batch_size * 4 * height * width * kernel_flops),
+            ('SubpixelConv', SubpixelConv(nr_filters, filter_shape),
+             batch_size * height * width * 4 * kernel_flops),
+            ('SubpixelConv (1x1)', SubpixelConv(nr_filters, (1, 1)),
+             batch_size * height * width * 4 * kernel_flops // onp.prod(filter_shape))):
+        params = upsampling.init_parameters(inputs, key=PRNGKey(0))
+        apply = jit(upsampling.apply)
+        apply(params, inputs).block_until_ready()
+
+        start = time.time()
+        for _ in range(repetitions):
+            apply(params, inputs).block_until_ready()
+        duration = (time.time() - start) / repetitions
+        print(f'{name}: {flops / 1e9:.2f} GFLOPs, {duration * 1000:.2f}ms.')
+
+
 def main(batch_size=32, nr_filters=8, epochs=10, step_size=.001, decay_rate=.999995,
          model_path=Path('./pixelcnn.params')):
     loss, _ = PixelCNNPP(nr_filters=nr_filters)
@@ -5,13 +5,14 @@ from typing import Iterable
 
 import dill
 import jax
-from jax import lax, random, unzip2, safe_zip, safe_map, partial, raise_to_shaped, tree_flatten, \
+from jax import random, unzip2, safe_zip, safe_map, partial, raise_to_shaped, tree_flatten, \
     tree_unflatten, flatten_fun_nokwargs, jit, curry
 from jax.abstract_arrays import ShapedArray
 from jax.core import new_master, cur_sublevel, Tracer, Trace, Primitive, get_aval, unit, \
-    TypedJaxpr, MasterTrace, full_lower, valid_jaxtype, trace_state, find_top_trace
+    TypedJaxpr, MasterTrace, full_lower, valid_jaxtype, trace_state, find_top_trace, Literal, \
+    unitvar
 from jax.interpreters.partial_eval import trace_to_jaxpr, PartialVal, convert_constvars_jaxpr
-from jax.lax.lax_control_flow import _index_array, scan_p, _abstractify, _scan_impl
+from jax.lax.lax_control_flow import scan_p, while_p, cond_p, _abstractify
 from jax.linear_util import wrap_init, transformation, transformation_with_aux
 from jax.random import PRNGKey
 from jax.util import split_list, split_dict, cache
@@ -118,7 +119,7 @@ class parametrized(Primitive):
     def parameters_from(self, reuse, *example_inputs):
         return self._init_parameters(*example_inputs, key=PRNGKey(0), reuse=reuse, reuse_only=True)
 
-    def _apply(self, parameters, *inputs, key):
+    def _apply(self, parameters, *inputs, key, interceptor=None):
         flat_inputs, in_tree = tree_flatten(inputs)
         flat_fun, out_tree = flatten_fun_nokwargs(self._wrapped_fun, in_tree)
         apply_trace = _top_trace(filter_type=ApplyTrace)
@@ -126,12 +127,26 @@ class parametrized(Primitive):
             global_parameters_by_primitive = apply_trace.state.global_parameters_by_primitive \
                 if apply_trace else {}
             random_state = apply_trace.state.random_state if apply_trace else RandomState(key)
-            master.state = ApplyTraceState(random_state, parameters, global_parameters_by_primitive)
+            interceptor = apply_trace.state.interceptor if apply_trace else interceptor
+            path = apply_trace.state.submodule_path if apply_trace else ''
+            master.state = ApplyTraceState(random_state, parameters, global_parameters_by_primitive,
+                                           interceptor, path)
             flat_outputs = _apply_transform(flat_fun, master).call_wrapped(*flat_inputs)
             del master
         return tree_unflatten(out_tree(), flat_outputs)
 
-    def apply(self, parameters, *inputs, key=no_key, jit=False):
+    def apply(self, parameters, *inputs, key=no_key, jit=False, interceptor=None):
+        """If given, `interceptor(submodule, parameters, *inputs, path=path)` is called instead of
+        `submodule.apply(parameters, *inputs)` for every (nested) submodule,
+        allowing to inspect or modify their inputs and outputs. `path` is the path of field names
+        to the submodule's parameters, such as 'sequential/dense0'.
+        Not supported with `jit=True`, jit the calling function instead."""
+        if interceptor is not None:
+            if jit:
+                raise ValueError('Interceptors are not supported with `jit=True`.')
+
+            return self._apply(parameters, *inputs, key=key, interceptor=interceptor)
+
         return (self._jitted_apply if jit else self._apply)(parameters, *inputs, key=key)
 
     def apply_from(self, reuse, *example_inputs, key=no_key, jit=False):
@@ -280,7 +295,7 @@ class Parameter(parametrized):
         self._init_parameter = init_parameter
         super().__init__(fun=None, name=name if name else 'parameter')
 
-    def apply(self, parameters, *inputs, key=no_key, jit=False):
+    def apply(self, parameters, *inputs, key=no_key, jit=False, interceptor=None):
         assert len(inputs) == 0
         return parameters
 
@@ -338,26 +353,6 @@ def _flat_initial_style_jaxpr(fun, in_avals):
                       out_avals=map(raise_to_shaped, out_avals)), consts
 
 
-def _custom_cell_scan_impl(flat_cell, *args, **kwargs):
-    """lax_control_flow._scan_impl, but allowing for a custom cell function."""
-
-    forward, length, num_consts, num_carry, jaxpr, linear = split_dict(
-        kwargs, ["forward", "length", "num_consts", "num_carry", "jaxpr", "linear"])
-
-    consts, init, xs = split_list(args, [num_consts, num_carry])
-    _, _, x_avals = split_list(jaxpr.in_avals, [num_consts, num_carry])
-    cell_args = consts + init + map(partial(_index_array, 0), x_avals, xs)
-
-    jaxpr, new_consts = _flat_initial_style_jaxpr(wrap_init(flat_cell), _abstractified(cell_args))
-
-    args = list(new_consts) + init + xs
-    kwargs['jaxpr'] = jaxpr
-    kwargs['num_consts'] = len(new_consts)
-    kwargs['linear'] = (False,) * len(args)
-
-    return scan_p.bind(*args, **kwargs)
-
-
 class ParametrizedTracer(Tracer):
     """Tracer (= wrapper around value to compose a compute graph) used during tracing of a
     `parameterized` function to get the corresponding `init_parameters` or `apply` function."""
@@ -441,21 +436,77 @@ class ParametrizedTrace(Trace):
     def _process_jitted(self, primitive, f, inputs, kwargs):
         assert False
 
-    _rules = {lax.scan_p: lambda self: self._process_scan,
+    _rules = {scan_p: lambda self: self._process_scan,
+              while_p: lambda self: self._process_while,
+              cond_p: lambda self: self._process_cond,
               random_key_p: lambda self: self._process_random_key}
 
-    def _process_scan(self, args, kwargs):
-        jaxpr = kwargs['jaxpr']
+    def _eval_jaxpr(self, jaxpr, consts, freevar_vals, *args):
+        """`jax.core.eval_jaxpr`, but processing each equation with this trace, so that
+        parametrized submodules are initialized or applied (also within nested control flow)."""
+        env = {unitvar: unit}
+
+        def read(var):
+            return var.val if type(var) is Literal else env[var]
+
+        def write(variables, vals):
+            env.update(zip(variables, vals))
+
+        write(jaxpr.constvars, consts)
+        write(jaxpr.invars, args)
+        write(jaxpr.freevars, freevar_vals)
+        for eqn in jaxpr.eqns:
+            inputs = map(read, eqn.invars)
+            if eqn.bound_subjaxprs:
+                subfuns = [wrap_init(partial(self._eval_jaxpr, subjaxpr, map(read, const_vars),
+                                             map(read, freevar_vars)))
+                           for subjaxpr, const_vars, freevar_vars in eqn.bound_subjaxprs]
+                outputs = eqn.primitive.bind(*subfuns, *inputs, **eqn.params)
+            else:
+                outputs = self._process_primitive(eqn.primitive, inputs, eqn.params)
+
+            write(eqn.outvars, outputs if eqn.primitive.multiple_results else [outputs])
+        return map(read, jaxpr.outvars)
 
-        is_cell_parametrized = (len(jaxpr.jaxpr.eqns) == 1 and
-                                isinstance(jaxpr.jaxpr.eqns[0].primitive, parametrized))
+    def _processed_jaxpr(self, jaxpr: TypedJaxpr, consts):
+        """Retraces the body of a control flow primitive with its parametrized submodules
+        processed by this trace. Returns the new body and its constants."""
+        _, in_avals = split_list(jaxpr.in_avals, [len(consts)])
 
-        if not is_cell_parametrized:
-            return _scan_impl(*args, **kwargs)
+        def body(*args):
+            return self._eval_jaxpr(jaxpr.jaxpr, jaxpr.literals, (), *consts, *args)
 
-        eqn, = jaxpr.jaxpr.eqns
-        flat_cell = partial(self.process_parametrized, eqn.primitive, **eqn.params)
-        return _custom_cell_scan_impl(flat_cell, *args, **kwargs)
+        jaxpr, consts = _flat_initial_style_jaxpr(wrap_init(body), tuple(in_avals))
+        return jaxpr, list(consts)
+
+    def _process_scan(self, args, kwargs):
+        consts, args = split_list(args, [kwargs['num_consts']])
+        jaxpr, consts = self._processed_jaxpr(kwargs['jaxpr'], consts)
+        kwargs = dict(kwargs, jaxpr=jaxpr, num_consts=len(consts),
+                      linear=(False,) * (len(consts) + len(args)))
+        return scan_p.bind(*consts, *args, **kwargs)
+
+    def _process_while(self, args, kwargs):
+        cond_nconsts, cond_jaxpr, body_nconsts, body_jaxpr = split_dict(
+            kwargs, ['cond_nconsts', 'cond_jaxpr', 'body_nconsts', 'body_jaxpr'])
+        cond_consts, body_consts, init = split_list(args, [cond_nconsts, body_nconsts])
+        cond_jaxpr, cond_consts = self._processed_jaxpr(cond_jaxpr, cond_consts)
+        body_jaxpr, body_consts = self._processed_jaxpr(body_jaxpr, body_consts)
+        return while_p.bind(*cond_consts, *body_consts, *init,
+                            cond_nconsts=len(cond_consts), cond_jaxpr=cond_jaxpr,
+                            body_nconsts=len(body_consts), body_jaxpr=body_jaxpr)
+
+    def _process_cond(self, args, kwargs):
+        true_jaxpr, false_jaxpr, true_nconsts, false_nconsts = split_dict(
+            kwargs, ['true_jaxpr', 'false_jaxpr', 'true_nconsts', 'false_nconsts'])
+        pred, *args = args
+        true_consts, true_ops, false_consts, false_ops = split_list(
+            args, [true_nconsts, len(true_jaxpr.in_avals) - true_nconsts, false_nconsts])
+        true_jaxpr, true_consts = self._processed_jaxpr(true_jaxpr, true_consts)
+        false_jaxpr, false_consts = self._processed_jaxpr(false_jaxpr, false_consts)
+        return cond_p.bind(pred, *true_consts, *true_ops, *false_consts, *false_ops,
+                           true_jaxpr=true_jaxpr, false_jaxpr=false_jaxpr,
+                           true_nconsts=len(true_consts), false_nconsts=len(false_consts))
 
     def _process_random_key(self, args, kwargs):
         assert len(args) == 0
@@ -541,24 +592,34 @@ def _apply_transform(master: MasterTrace, *inputs):
 
 class ApplyTraceState(ParametrizedTraceState):
     """Allows supplying submodules with their respective parameters while calling a module's `apply`
-    function by iterating through the given parameters."""
+    function by iterating through the given parameters.
+    Also tracks the paths of these parameters, such as 'sequential/dense0', where `path`
+    is the path of the given parameters. Nested `apply` calls continue from the path of the most
+    recent submodule, as when applying a model to parameters obtained from a `Parameter`."""
 
-    def __init__(self, random_state, parameters, global_parameters_by_primitive):
+    def __init__(self, random_state, parameters, global_parameters_by_primitive,
+                 interceptor=None, path=''):
         super().__init__(random_state)
 
         self.parameters = parameters
         self._index = 0
         self.global_parameters_by_primitive = global_parameters_by_primitive
+        self.interceptor = interceptor
+        self.path = path
+        self.submodule_path = path
 
     def next_parameters_for(self, primitive: Primitive):
-        parameters = self.global_parameters_by_primitive.get(primitive)
-        if parameters is not None:
-            return parameters
-
-        parameters = self.parameters[self._index]
+        """Returns the parameters for `primitive` together with their path."""
+        parameters_and_path = self.global_parameters_by_primitive.get(primitive)
+        if parameters_and_path is not None:
+            return parameters_and_path
+
+        names = getattr(self.parameters, '_fields', range(len(self.parameters)))
+        parameters_and_path = (self.parameters[self._index],
+                               _child_path(self.path, names[self._index]))
         self._index += 1
-        self.global_parameters_by_primitive[primitive] = parameters
-        return parameters
+        self.global_parameters_by_primitive[primitive] = parameters_and_path
+        return parameters_and_path
 
 
 class ApplyTrace(ParametrizedTrace):
@@ -569,13 +630,39 @@ class ApplyTrace(ParametrizedTrace):
         return self.master.state
 
     def _process_parametrized_nonflat(self, primitive: parametrized, *inputs):
-        return primitive.apply(self.state.next_parameters_for(primitive), *inputs)
+        parameters, self.state.submodule_path = self.state.next_parameters_for(primitive)
+        if self.state.interceptor is None:
+            return primitive.apply(parameters, *inputs)
+
+        return self.state.interceptor(primitive, parameters, *inputs,
+                                      path=self.state.submodule_path)
 
     def _process_jitted(self, primitive, f, inputs, kwargs):
         fun = _apply_transform(f, self.master)
         return primitive.bind(fun, *inputs, **kwargs)
 
 
+def _child_path(path, name):
+    return f'{path}/{name}' if path else str(name)
+
+
+def _parameter_paths(parameters, path=''):
+    """Returns a tree like `parameters`, with each array replaced by its path,
+    joined from the field names of the enclosing namedtuples, such as 'sequential/dense0/kernel'."""
+
+    if isinstance(parameters, dict):
+        return {name: _parameter_paths(p, _child_path(path, name))
+                for name, p in parameters.items()}
+
+    if isinstance(parameters, (tuple, list)):
+        names = getattr(parameters, '_fields', range(len(parameters)))
+        paths = [_parameter_paths(p, _child_path(path, name)) for name, p in zip(names, parameters)]
+        return type(parameters)(*paths) if hasattr(parameters, '_fields') \
+            else type(parameters)(paths)
+
+    return path
+
+
 def _get_name_for(fun):
     while hasattr(fun, '__wrapped__'):
         fun = fun.__wrapped__
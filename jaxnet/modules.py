@@ -1,11 +1,19 @@
 import functools
 import itertools
-
-from jax import random, lax, numpy as np, tree_map, tree_leaves, vmap, partial
-from jax.nn import sigmoid
+import json
+import math
+import time
+from collections import namedtuple
+from pathlib import Path
+
+from jax import random, lax, numpy as np, tree_map, tree_multimap, tree_leaves, vmap, partial, jit
+from jax.nn import sigmoid, softmax
+from jax.lib.xla_bridge import get_backend
+from jax.ops import index_add
 from jax.nn.initializers import glorot_normal, normal, zeros, ones
 
-from jaxnet.core import parametrized, Parameter, random_key
+from jaxnet.core import parametrized, Parameter, random_key, no_key, _child_path, \
+    _parameter_paths
 
 
 def parameter(shape, init, name=None):
@@ -52,8 +60,14 @@ def flatten(x):
 
 
 def GeneralConv(dimension_numbers, out_chan, filter_shape, strides=None, padding='VALID',
-                kernel_init=None, bias_init=normal(1e-6), dilation=None):
-    """Layer construction function for a general convolution layer."""
+                kernel_init=None, bias_init=normal(1e-6), dilation=None, groups=1,
+                autotuner=None):
+    """Layer construction function for a general convolution layer.
+    With `groups`, input and output channels are split into that many groups,
+    each convolved separately, dividing FLOPs and kernel size by `groups`.
+    `groups` equal to the number of input channels gives a depthwise convolution.
+    With a `ConvAutotuner`, the convolution is computed in the layout it chose.
+    With `bias_init=None`, the layer has no bias."""
     lhs_spec, rhs_spec, out_spec = dimension_numbers
     one = (1,) * len(filter_shape)
     strides = strides or one
@@ -62,18 +76,23 @@ def GeneralConv(dimension_numbers, out_chan, filter_shape, strides=None, padding
 
     @parametrized
     def conv(inputs):
+        in_chan = inputs.shape[lhs_spec.index('C')]
+        if in_chan % groups or out_chan % groups:
+            raise ValueError(f'Input channels ({in_chan}) and output channels ({out_chan}) '
+                             f'must be divisible by groups ({groups}).')
+
         filter_shape_iter = iter(filter_shape)
         kernel_shape = [out_chan if c == 'O' else
-                        inputs.shape[lhs_spec.index('C')] if c == 'I' else
+                        in_chan // groups if c == 'I' else
                         next(filter_shape_iter) for c in rhs_spec]
         bias_shape = tuple(itertools.dropwhile(lambda x: x == 1,
                                                [out_chan if c == 'C' else 1 for c in out_spec]))
 
         kernel = parameter(kernel_shape, kernel_init, 'kernel')
-        bias = parameter(bias_shape, bias_init, 'bias')
-        return lax.conv_general_dilated(inputs, kernel, strides, padding,
-                                        lhs_dilation=one, rhs_dilation=dilation,
-                                        dimension_numbers=dimension_numbers) + bias
+        convolve = autotuner.convolve if autotuner else _convolve
+        outputs = convolve(inputs, kernel, strides, padding, dilation, dimension_numbers, groups)
+        return outputs if bias_init is None else \
+            outputs + parameter(bias_shape, bias_init, 'bias')
 
     return conv
 
@@ -82,6 +101,207 @@ Conv = functools.partial(GeneralConv, ('NHWC', 'HWIO', 'NHWC'))
 Conv1D = functools.partial(GeneralConv, ('NTC', 'TIO', 'NTC'))
 
 
+def _convolve(inputs, kernel, strides, padding, dilation, dimension_numbers, groups=1):
+    return lax.conv_general_dilated(inputs, kernel, strides, padding,
+                                    lhs_dilation=(1,) * len(strides), rhs_dilation=dilation,
+                                    dimension_numbers=dimension_numbers,
+                                    feature_group_count=groups)
+
+
+def _transposed(x, spec, target_spec):
+    return x if spec == target_spec else np.transpose(x, [spec.index(c) for c in target_spec])
+
+
+def _convolve_in_layout(layout, inputs, kernel, strides, padding, dilation, dimension_numbers,
+                        groups):
+    """Convolution with arrays in the given `dimension_numbers`, computed in another `layout`
+    (dimension numbers or 'fft'), transposing inputs, kernel and outputs as needed."""
+    lhs_spec, rhs_spec, out_spec = dimension_numbers
+    if layout == 'fft':
+        spatial, = (c for c in lhs_spec if c not in 'NC')
+        kernel_spatial, = (c for c in rhs_spec if c not in 'IO')
+        layout = 'N' + spatial + 'C', kernel_spatial + 'IO', 'N' + spatial + 'C'
+        outputs = _fft_conv1d(_transposed(inputs, lhs_spec, layout[0]),
+                              _transposed(kernel, rhs_spec, layout[1]), padding, *dilation)
+    else:
+        outputs = lax.conv_general_dilated(
+            _transposed(inputs, lhs_spec, layout[0]), _transposed(kernel, rhs_spec, layout[1]),
+            strides, padding, lhs_dilation=(1,) * len(strides), rhs_dilation=dilation,
+            dimension_numbers=layout, feature_group_count=groups)
+    return _transposed(outputs, layout[2], out_spec)
+
+
+def _conv_layouts(dimension_numbers, strides, groups):
+    lhs_spec, rhs_spec, out_spec = dimension_numbers
+    spatial = ''.join(c for c in lhs_spec if c not in 'NC')
+    kernel_spatial = ''.join(c for c in rhs_spec if c not in 'IO')
+    out_spatial = ''.join(c for c in out_spec if c not in 'NC')
+    candidates = itertools.product(('N' + spatial + 'C', 'NC' + spatial),
+                                   (kernel_spatial + 'IO', 'OI' + kernel_spatial),
+                                   ('N' + out_spatial + 'C', 'NC' + out_spatial))
+    layouts = [tuple(dimension_numbers)]
+    layouts += [layout for layout in candidates if layout != layouts[0]]
+    if len(spatial) == 1 and strides == (1,) and groups == 1:
+        layouts.append('fft')
+    return layouts
+
+
+class ConvAutotuner:
+    """Chooses the fastest way to compute each convolution, out of all combinations of
+    channels-first/-last dimension numbers and, for 1D convolutions, FFT-based computation.
+    Pass it to convolution layers via `autotuner`. A convolution without a choice is benchmarked
+    when it is first traced, on arrays of its shapes created outside of the trace, so that
+    already jitted functions use the choice as well. Choices are made per shape, dtype and
+    backend and stored as JSON in `cache_path`, to be reused in later runs.
+    The parameter layout of convolution layers is not affected."""
+
+    def __init__(self, cache_path=None, repetitions=10):
+        self.cache_path = Path(cache_path or Path.home() / '.jaxnet' / 'conv_autotuning.json')
+        self.repetitions = repetitions
+        self.choices = json.loads(self.cache_path.read_text()) if self.cache_path.exists() else {}
+
+    def convolve(self, inputs, kernel, strides, padding, dilation, dimension_numbers, groups=1):
+        strides, dilation = tuple(strides), tuple(dilation)
+        convolve = partial(_convolve_in_layout, strides=strides, padding=padding,
+                           dilation=dilation, dimension_numbers=dimension_numbers, groups=groups)
+        key = repr((get_backend().platform, str(inputs.dtype), inputs.shape, kernel.shape,
+                    strides, padding, dilation, tuple(dimension_numbers), groups))
+        layout = self.choices.get(key)
+        if layout is None:
+            layout = self._fastest(convolve, _conv_layouts(dimension_numbers, strides, groups),
+                                   inputs.shape, inputs.dtype, kernel.shape, kernel.dtype)
+            self.choices[key] = layout if layout == 'fft' else list(layout)
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            self.cache_path.write_text(json.dumps(self.choices, indent=1))
+
+        return convolve(layout if layout == 'fft' else tuple(layout), inputs, kernel)
+
+    def _fastest(self, convolve, layouts, inputs_shape, inputs_dtype, kernel_shape, kernel_dtype):
+        inputs, kernel = np.zeros(inputs_shape, inputs_dtype), np.zeros(kernel_shape, kernel_dtype)
+
+        def duration(layout):
+            fun = jit(partial(convolve, layout))
+            fun(inputs, kernel).block_until_ready()  # compile
+            start = time.time()
+            for _ in range(self.repetitions):
+                fun(inputs, kernel).block_until_ready()
+            return time.time() - start
+
+        return min(layouts, key=duration)
+
+
+def GeneralSeparableConv(dimension_numbers, out_chan, filter_shape, strides=None,
+                         padding='VALID', depth_multiplier=1, kernel_init=None,
+                         bias_init=normal(1e-6), dilation=None):
+    """Layer construction function for a depthwise separable convolution layer:
+    a depthwise convolution with `depth_multiplier` filters per input channel,
+    followed by a pointwise (1x1) convolution mixing channels.
+    Only the pointwise convolution has a bias, which makes a depthwise bias redundant."""
+
+    lhs_spec, _, _ = dimension_numbers
+
+    @parametrized
+    def separable_conv(inputs):
+        in_chan = inputs.shape[lhs_spec.index('C')]
+        depthwise = GeneralConv(dimension_numbers, in_chan * depth_multiplier, filter_shape,
+                                strides, padding, kernel_init, bias_init=None,
+                                dilation=dilation, groups=in_chan)
+        pointwise = GeneralConv(dimension_numbers, out_chan, (1,) * len(filter_shape),
+                                kernel_init=kernel_init, bias_init=bias_init)
+        return pointwise(depthwise(inputs))
+
+    return separable_conv
+
+
+SeparableConv = functools.partial(GeneralSeparableConv, ('NHWC', 'HWIO', 'NHWC'))
+SeparableConv1D = functools.partial(GeneralSeparableConv, ('NTC', 'TIO', 'NTC'))
+
+
+def _fft_conv1d(inputs, kernel, padding, dilation):
+    """Same as `lax.conv_general_dilated` with dimension numbers ('NTC', 'TIO', 'NTC')
+    and unit strides, but computed via FFT in O(T log T) instead of O(T K)."""
+    width = (kernel.shape[0] - 1) * dilation + 1
+    kernel = np.pad(kernel[:, None], [(0, 0), (0, dilation - 1), (0, 0), (0, 0)], mode='constant')
+    kernel = np.reshape(kernel, (-1,) + kernel.shape[2:])[:width]
+    if isinstance(padding, str):
+        padding = lax.padtype_to_pads(inputs.shape[1:2], (width,), (1,), padding)
+    (low, high), = padding
+    inputs = np.pad(inputs, [(0, 0), (low, high), (0, 0)], mode='constant')
+
+    # Circular correlation does not wrap around for valid outputs if the FFT covers the inputs:
+    length = inputs.shape[1]
+    fft_length = 1 << (length - 1).bit_length()
+
+    def fft(x, time_axis):
+        x = np.moveaxis(x, time_axis, -1)
+        x = np.pad(x, [(0, 0)] * (x.ndim - 1) + [(0, fft_length - x.shape[-1])], mode='constant')
+        return np.fft.fftn(x, axes=(-1,))
+
+    outputs = np.einsum('bif,iof->bof', fft(inputs, 1), np.conj(fft(kernel, 0)))
+    outputs = np.real(np.fft.ifftn(outputs, axes=(-1,)))[..., :length - width + 1]
+    return np.moveaxis(outputs, -1, 1)
+
+
+def FFTConv1D(out_chan, filter_shape, padding='VALID', kernel_init=None, bias_init=normal(1e-6),
+              dilation=None, crossover=None):
+    """Layer construction function for a 1D convolution with the same parameters as `Conv1D`,
+    computed via FFT if the dilated filter spans at least `crossover` time steps,
+    and directly otherwise. By default, `crossover` is measured with `fft_crossover` when the
+    layer is first traced, once per input length, channels and backend."""
+
+    dimension_numbers = ('NTC', 'TIO', 'NTC')
+    kernel_init = kernel_init or glorot_normal(2, 1)
+    dilation, = dilation or (1,)
+
+    @parametrized
+    def conv(inputs):
+        width, = filter_shape
+        kernel = parameter((width, inputs.shape[2], out_chan), kernel_init, 'kernel')
+        bias = parameter((out_chan,), bias_init, 'bias')
+        min_fft_width = crossover or _measured_fft_crossover(
+            inputs.shape[1], inputs.shape[2], out_chan, get_backend().platform)
+        if (width - 1) * dilation + 1 < min_fft_width:
+            return lax.conv_general_dilated(inputs, kernel, (1,), padding, lhs_dilation=(1,),
+                                            rhs_dilation=(dilation,),
+                                            dimension_numbers=dimension_numbers) + bias
+
+        return _fft_conv1d(inputs, kernel, padding, dilation) + bias
+
+    return conv
+
+
+def fft_crossover(length, in_chan, out_chan, batch_size=1, max_width=1024, repetitions=10):
+    """Measures the smallest filter width (as power of two) for which an `FFTConv1D` is
+    faster via FFT than via direct convolution on the current backend."""
+
+    inputs = np.zeros((batch_size, length, in_chan))
+
+    def duration(conv, kernel):
+        conv(inputs, kernel).block_until_ready()  # compile
+        start = time.time()
+        for _ in range(repetitions):
+            conv(inputs, kernel).block_until_ready()
+        return time.time() - start
+
+    direct = jit(partial(lax.conv_general_dilated, window_strides=(1,), padding='VALID',
+                         dimension_numbers=('NTC', 'TIO', 'NTC')))
+    fft = jit(partial(_fft_conv1d, padding='VALID', dilation=1))
+    width = 1
+    while width <= min(max_width, length):
+        kernel = np.zeros((width, in_chan, out_chan))
+        if duration(fft, kernel) < duration(direct, kernel):
+            return width
+        width *= 2
+
+    return max_width + 1
+
+
+@functools.lru_cache()
+def _measured_fft_crossover(length, in_chan, out_chan, platform):
+    # platform is only part of the cache key, measurements run on the default backend:
+    return fft_crossover(length, in_chan, out_chan)
+
+
 def GeneralConvTranspose(dimension_numbers, out_chan, filter_shape,
                          strides=None, padding='VALID', kernel_init=None,
                          bias_init=normal(1e-6)):
@@ -115,6 +335,87 @@ ConvTranspose = functools.partial(GeneralConvTranspose, ('NHWC', 'HWIO', 'NHWC')
 Conv1DTranspose = functools.partial(GeneralConvTranspose, ('NTC', 'TIO', 'NTC'))
 
 
+def DepthToSpace(block_size):
+    """Layer construction function for a depth-to-space (pixel shuffle) layer, rearranging
+    channel blocks of inputs with layout NHWC (or NTC, ...) into `block_size` times larger
+    spatial dimensions. A pure reshape and transpose, without parameters."""
+
+    def depth_to_space(inputs):
+        batch_size, *spatial_shape, channels = inputs.shape
+        dims = len(spatial_shape)
+        if channels % block_size ** dims != 0:
+            raise ValueError(f'Number of channels ({channels}) must be divisible '
+                             f'by {block_size ** dims}.')
+
+        out_chan = channels // block_size ** dims
+        x = np.reshape(inputs, (batch_size, *spatial_shape, *(block_size,) * dims, out_chan))
+        x = np.transpose(x, (0, *itertools.chain(*((1 + i, 1 + dims + i) for i in range(dims))),
+                             1 + 2 * dims))
+        return np.reshape(x, (batch_size, *(d * block_size for d in spatial_shape), out_chan))
+
+    return depth_to_space
+
+
+PixelShuffle = DepthToSpace
+
+
+def _upsample_linear(x, axis, scale):
+    length = x.shape[axis]
+    # half-pixel centers, clamped at the borders:
+    positions = np.clip((np.arange(length * scale) + .5) / scale - .5, 0, length - 1)
+    lower = np.floor(positions).astype(np.int32)
+    upper = np.minimum(lower + 1, length - 1)
+    weight = np.reshape(positions - lower, (-1,) + (1,) * (np.ndim(x) - axis - 1)).astype(x.dtype)
+    return np.take(x, lower, axis) * (1 - weight) + np.take(x, upper, axis) * weight
+
+
+def Upsample(scale, method='nearest'):
+    """Layer construction function for an upsampling layer, resizing the spatial dimensions of
+    inputs with layout NHWC (or NTC, ...) by integer `scale` factors, with `method` either
+    'nearest' (repeating values) or 'bilinear' (interpolating between the two nearest values
+    along each axis, also for other numbers of spatial dimensions)."""
+
+    if method not in ('nearest', 'bilinear'):
+        raise ValueError(f"Unknown upsampling method '{method}'.")
+
+    def upsample(inputs):
+        scales = (scale,) * (np.ndim(inputs) - 2) if np.isscalar(scale) else scale
+        for axis, axis_scale in enumerate(scales, 1):
+            inputs = np.repeat(inputs, axis_scale, axis) if method == 'nearest' else \
+                _upsample_linear(inputs, axis, axis_scale)
+        return inputs
+
+    return upsample
+
+
+def ResizeConv(out_chan, filter_shape, scale=2, method='nearest', padding='SAME', **kwargs):
+    """Layer construction function for an upsampling `Conv`, an alternative to
+    `ConvTranspose` with `strides=(scale, scale)` that avoids checkerboard artifacts.
+    Upsamples with `Upsample` before convolving at the output resolution."""
+
+    upsample = Upsample(scale, method)
+
+    @parametrized
+    def resize_conv(inputs):
+        return Conv(out_chan, filter_shape, padding=padding, **kwargs)(upsample(inputs))
+
+    return resize_conv
+
+
+def SubpixelConv(out_chan, filter_shape, scale=2, padding='SAME', **kwargs):
+    """Layer construction function for an upsampling `Conv`, an alternative to
+    `ConvTranspose` with `strides=(scale, scale)` that avoids checkerboard artifacts.
+    Convolves at the input resolution into `scale ** 2` times the channels,
+    which are then rearranged with `PixelShuffle`."""
+
+    @parametrized
+    def subpixel_conv(inputs):
+        return PixelShuffle(scale)(
+            Conv(out_chan * scale ** 2, filter_shape, padding=padding, **kwargs)(inputs))
+
+    return subpixel_conv
+
+
 def _pool(reducer, init_val, rescaler=None):
     def Pool(window_shape, strides=None, padding='VALID'):
         """Layer construction function for a pooling layer."""
@@ -148,19 +449,41 @@ def _normalize_by_window_size(dims, strides, padding):
 AvgPool = _pool(lax.add, 0., _normalize_by_window_size)
 
 
+HoistedCell = namedtuple('HoistedCell', ('project_inputs', 'step'))
+HoistedCell.__doc__ = """Allows `Rnn` to compute the input-dependent part of a cell
+for all time steps at once, before the recurrence. `project_inputs(params, xs)` returns
+`(projected_xs, step_params)`, and `step(step_params, carry, projected_x)` returns `(carry, y)`
+like the cell itself."""
+
+
 def GRUCell(carry_size, param_init):
+    GRUParameters = namedtuple('gru_cell', ('update_kernel', 'reset_kernel', 'compute_kernel'))
+
+    def project_inputs(params, xs):
+        x_size = params.update_kernel.shape[0] - carry_size
+        input_kernel = np.concatenate([kernel[:x_size] for kernel in params], axis=1)
+        gate_kernel = np.concatenate((params.update_kernel[x_size:],
+                                      params.reset_kernel[x_size:]), axis=1)
+        return np.dot(xs, input_kernel), (gate_kernel, params.compute_kernel[x_size:])
+
+    def step(step_params, carry, projected_x):
+        gate_kernel, compute_kernel = step_params
+        x_gates, x_compute = np.split(projected_x, [2 * carry_size], axis=-1)
+        update, reset = np.split(sigmoid(x_gates + np.dot(carry, gate_kernel)), 2, axis=-1)
+        compute = np.tanh(x_compute + np.dot(reset * carry, compute_kernel))
+        out = update * compute + (1 - update) * carry
+        return out, out
+
     @parametrized
     def gru_cell(carry, x):
         def param(name):
             return parameter((x.shape[1] + carry_size, carry_size), param_init, name)
 
-        both = np.concatenate((x, carry), axis=1)
-        update = sigmoid(np.dot(both, param('update_kernel')))
-        reset = sigmoid(np.dot(both, param('reset_kernel')))
-        both_reset_carry = np.concatenate((x, reset * carry), axis=1)
-        compute = np.tanh(np.dot(both_reset_carry, param('compute_kernel')))
-        out = update * compute + (1 - update) * carry
-        return out, out
+        params = GRUParameters(*map(param, GRUParameters._fields))
+        projected_x, step_params = project_inputs(params, x)
+        return step(step_params, carry, projected_x)
+
+    gru_cell.hoisted = HoistedCell(project_inputs, step)
 
     def carry_init(batch_size):
         return np.zeros((batch_size, carry_size))
@@ -168,20 +491,119 @@ def GRUCell(carry_size, param_init):
     return gru_cell, carry_init
 
 
-def Rnn(cell, carry_init):
+def LSTMCell(carry_size, param_init, bias_init=zeros, forget_bias=1.):
+    """LSTM cell computing all gates with a single fused matmul.
+    The carry is a tuple `(hidden, cell_state)`."""
+
+    def project_inputs(params, xs):
+        x_size = params.kernel.shape[0] - carry_size
+        return np.dot(xs, params.kernel[:x_size]) + params.bias, params.kernel[x_size:]
+
+    def step(recurrent_kernel, carry, projected_x):
+        hidden, cell_state = carry
+        gates = projected_x + np.dot(hidden, recurrent_kernel)
+        input_gate, forget_gate, output_gate, candidate = np.split(gates, 4, axis=-1)
+        cell_state = (sigmoid(forget_gate + forget_bias) * cell_state +
+                      sigmoid(input_gate) * np.tanh(candidate))
+        hidden = sigmoid(output_gate) * np.tanh(cell_state)
+        return (hidden, cell_state), hidden
+
+    @parametrized
+    def lstm_cell(carry, x):
+        kernel = parameter((x.shape[1] + carry_size, 4 * carry_size), param_init, 'kernel')
+        bias = parameter((4 * carry_size,), bias_init, 'bias')
+        return step(kernel[x.shape[1]:], carry, np.dot(x, kernel[:x.shape[1]]) + bias)
+
+    lstm_cell.hoisted = HoistedCell(project_inputs, step)
+
+    def carry_init(batch_size):
+        return np.zeros((batch_size, carry_size)), np.zeros((batch_size, carry_size))
+
+    return lstm_cell, carry_init
+
+
+def Rnn(cell, carry_init, return_carry=False):
     """Layer construction function for recurrent neural nets.
     Expecting input shape (batch, sequence, channels).
-    TODO allow returning last carry."""
+    Optionally takes an initial carry as second input, and returns the final carry
+    in addition to the outputs if `return_carry` is set.
+    For cells with a `hoisted` attribute (see `HoistedCell`), input projections
+    are computed for all time steps in one batched matmul outside of the recurrence.
+
+    Padded sequences are supported by passing per-example `lengths` of shape (batch,)
+    as third input. Steps beyond an example's length leave its carry unchanged and
+    produce zero outputs, so the final carry is the one after the last valid step.
+    Use `pad_to_bucket` to limit the number of distinct sequence lengths (and thereby compilations).
+
+    For online inference, `rnn.step(params, carry, x)` processes a single time step
+    of shape (batch, channels), using the parameters of `rnn`, starting from
+    `rnn.carry_init(batch_size)`. It returns `(carry, y)` and can be jitted."""
+
+    def masked(step):
+        def masked_step(carry, x_and_mask):
+            x, mask = x_and_mask
+            new_carry, y = step(carry, x)
+
+            def select(new, old):
+                return np.where(np.reshape(mask, mask.shape + (1,) * (new.ndim - 1)), new, old)
+
+            return tree_multimap(select, new_carry, carry), select(y, np.zeros_like(y))
+
+        return masked_step
 
     @parametrized
-    def rnn(xs):
+    def rnn(xs, carry=None, lengths=None):
         xs = np.swapaxes(xs, 0, 1)
-        _, ys = lax.scan(cell, carry_init(xs.shape[1]), xs)
-        return np.swapaxes(ys, 0, 1)
-
+        carry = carry_init(xs.shape[1]) if carry is None else carry
+        hoisted = getattr(cell, 'hoisted', None)
+        if hoisted is None and lengths is None:
+            carry, ys = lax.scan(cell, carry, xs)
+        else:
+            init_carry = carry
+            params = Parameter(lambda key: cell.init_parameters(init_carry, xs[0], key=key),
+                               cell.__name__)()
+            if hoisted is None:
+                step = partial(cell.apply, params)
+            else:
+                xs, step_params = hoisted.project_inputs(params, xs)
+                step = partial(hoisted.step, step_params)
+
+            if lengths is None:
+                carry, ys = lax.scan(step, carry, xs)
+            else:
+                masks = np.arange(xs.shape[0])[:, None] < lengths
+                carry, ys = lax.scan(masked(step), carry, (xs, masks))
+        ys = np.swapaxes(ys, 0, 1)
+        return (ys, carry) if return_carry else ys
+
+    def step(params, carry, x):
+        cell_params, = params
+        return cell.apply(cell_params, carry, x)
+
+    rnn.step = step
+    rnn.carry_init = carry_init
     return rnn
 
 
+def bucket_length(length, buckets):
+    """Smallest of the given bucket lengths that is at least `length`."""
+    fitting = [bucket for bucket in buckets if bucket >= length]
+    if not fitting:
+        raise ValueError(f'Length {length} exceeds the largest bucket {max(buckets)}.')
+
+    return min(fitting)
+
+
+def pad_to_bucket(xs, buckets, axis=1):
+    """Zero-pads `xs` along `axis` to the smallest fitting bucket length.
+    Feeding only bucketed shapes to jitted functions bounds the number of compilations
+    by the number of buckets. Pass the original lengths to `Rnn` to mask the padding."""
+    length = xs.shape[axis]
+    padding = [(0, 0)] * xs.ndim
+    padding[axis] = (0, bucket_length(length, buckets) - length)
+    return np.pad(xs, padding, mode='constant')
+
+
 def Dropout(rate, test_mode=False):
     """Constructor for a dropout function with given rate."""
     rate = np.array(rate)
@@ -203,31 +625,211 @@ def fastvar(x, axis, keepdims):
     return np.mean(x ** 2, axis, keepdims=keepdims) - np.mean(x, axis, keepdims=keepdims) ** 2
 
 
+def _batch_moments(x, axis, axis_name=None):
+    if axis_name is None:
+        return np.mean(x, axis, keepdims=True), fastvar(x, axis, keepdims=True)
+
+    # one all-reduce for both moments, equal per-device batch sizes are guaranteed by pmap:
+    moments = lax.psum(np.stack((np.mean(x, axis, keepdims=True),
+                                 np.mean(x ** 2, axis, keepdims=True))), axis_name)
+    mean, mean_of_squares = moments / lax.psum(1, axis_name)
+    return mean, mean_of_squares - mean ** 2
+
+
 def BatchNorm(axis=(0, 1, 2), epsilon=1e-5, center=True, scale=True,
-              beta_init=zeros, gamma_init=ones):
-    """Layer construction function for a batch normalization layer."""
+              beta_init=zeros, gamma_init=ones, momentum=None, test_mode=False, axis_name=None):
+    """Layer construction function for a batch normalization layer.
+    With `momentum`, running averages of batch mean and variance are kept as parameters
+    `running_mean` and `running_var`, which are frozen for all optimizers and not regularized,
+    but updated from the batch statistics of a forward pass via `update_running_statistics`,
+    or within the update step via `Optimizer.update_with_running_statistics`.
+    In `test_mode`, these are used instead of batch statistics, so that outputs do not depend
+    on batch composition.
+    With `axis_name`, batch statistics are synchronized across devices of the `pmap` with this
+    axis name, so parameters have to be initialized and applied inside of such a `pmap`."""
 
     axis = (axis,) if np.isscalar(axis) else axis
+    if test_mode and momentum is None:
+        raise ValueError('Test mode requires running statistics, enable them via `momentum`.')
+
+    def batch_moments(x):
+        return tuple(np.squeeze(m, axis) for m in _batch_moments(x, axis, axis_name))
+
+    def normalize(x, mean, var, gamma, beta):
+        ed = tuple(None if i in axis else slice(None) for i in range(np.ndim(x)))
+        z = (x - mean[ed]) / np.sqrt(var[ed] + epsilon)
+        scaled = z * gamma[ed] if scale else z
+        return scaled + beta[ed] if center else scaled
 
     @parametrized
     def batch_norm(x):
-        ed = tuple(None if i in axis else slice(None) for i in range(np.ndim(x)))
-        mean, var = np.mean(x, axis, keepdims=True), fastvar(x, axis, keepdims=True)
-        z = (x - mean) / np.sqrt(var + epsilon)
         shape = tuple(d for i, d in enumerate(x.shape) if i not in axis)
+        if momentum is not None:
+            running_mean = parameter(shape, zeros, 'running_mean')
+            running_var = parameter(shape, ones, 'running_var')
+
+        mean, var = lax.stop_gradient((running_mean, running_var)) if test_mode \
+            else batch_moments(x)
+        gamma = parameter(shape, gamma_init, 'gamma') if scale else None
+        beta = parameter(shape, beta_init, 'beta') if center else None
+        return normalize(x, mean, var, gamma, beta)
+
+    def apply_and_update_statistics(params, x):
+        """Returns the outputs of `batch_norm` and `params` with the running statistics updated
+        from the batch statistics, which are computed once for both."""
+        batch_mean, batch_var = batch_moments(x)
+        mean, var = lax.stop_gradient((params.running_mean, params.running_var)) if test_mode \
+            else (batch_mean, batch_var)
+        outputs = normalize(x, mean, var, getattr(params, 'gamma', None),
+                            getattr(params, 'beta', None))
+        batch_mean, batch_var = lax.stop_gradient((batch_mean, batch_var))
+        return outputs, params._replace(
+            running_mean=momentum * params.running_mean + (1 - momentum) * batch_mean,
+            running_var=momentum * params.running_var + (1 - momentum) * batch_var)
+
+    if momentum is not None:
+        batch_norm.apply_and_update_statistics = apply_and_update_statistics
+
+    batch_norm.epsilon = epsilon
+    return batch_norm
 
-        scaled = z * parameter(shape, gamma_init, 'gamma')[ed] if scale else z
-        return scaled + parameter(shape, beta_init, 'beta')[ed] if center else scaled
 
-    return batch_norm
+_RUNNING_STATISTICS = ('running_mean', 'running_var')
+
+
+def _is_running_statistic(path):
+    """Whether `path` (such as 'sequential/batch_norm0/running_mean') is a running statistic
+    of a `BatchNorm`, recognized by its dedicated parameter name."""
+    return path.split('/')[-1] in _RUNNING_STATISTICS
+
+
+def update_running_statistics(model, params, *inputs, key=no_key):
+    """Applies `model` and returns its outputs together with `params`, where the running
+    statistics of all contained `BatchNorm`s (with `momentum`) are updated from the batch
+    statistics computed in this forward pass. To update them within each training step without
+    an additional forward pass, use `Optimizer.update_with_running_statistics`.
+    Not supported for `BatchNorm`s inside of `Rnn`s or other loops."""
+
+    if hasattr(model, 'apply_and_update_statistics'):
+        return model.apply_and_update_statistics(params, *inputs)
+
+    updated = {}
+
+    def interceptor(module, module_params, *module_inputs, path):
+        apply_and_update_statistics = getattr(module, 'apply_and_update_statistics', None)
+        if apply_and_update_statistics is None:
+            return module.apply(module_params, *module_inputs)
+
+        outputs, updated[path] = apply_and_update_statistics(module_params, *module_inputs)
+        return outputs
+
+    outputs = model.apply(params, *inputs, key=key, interceptor=interceptor)
+
+    def replaced(params, path):
+        if path in updated:
+            return updated[path]
+
+        if isinstance(params, (tuple, list)):
+            names = getattr(params, '_fields', range(len(params)))
+            children = [replaced(p, _child_path(path, name)) for name, p in zip(names, params)]
+            return type(params)(*children) if hasattr(params, '_fields') \
+                else type(params)(children)
+
+        return params
+
+    return outputs, replaced(params, '')
+
+
+def fold_batch_norm(batch_norm, params, batch_norm_params):
+    """Folds `batch_norm` (a `BatchNorm` in test mode, with parameters `batch_norm_params`)
+    into the preceding `Dense` or `Conv` layer, returning parameters for that layer that compute
+    both at once, for serving without normalization ops. The kernel's output channel axis is
+    expected to be last, as for `Dense`, `Conv` and `Conv1D`, with the `BatchNorm` normalizing
+    all other axes."""
+
+    scale = 1 / np.sqrt(batch_norm_params.running_var + batch_norm.epsilon)
+    if hasattr(batch_norm_params, 'gamma'):
+        scale = scale * batch_norm_params.gamma
+
+    bias = (params.bias - batch_norm_params.running_mean) * scale
+    if hasattr(batch_norm_params, 'beta'):
+        bias = bias + batch_norm_params.beta
+
+    return params._replace(kernel=params.kernel * scale, bias=bias)
+
+
+def _moments(x, axis):
+    """Mean and variance of `x` over `axis` in a single fused reduction of values and squares.
+    Computes in at least float32 and shifts values by their first element along `axis`,
+    avoiding the cancellation that `fastvar` suffers from for large means."""
+    x = x.astype(np.promote_types(x.dtype, np.float32))
+    shift = lax.stop_gradient(x[tuple(slice(0, 1) if i in axis else slice(None)
+                                      for i in range(np.ndim(x)))])
+    shifted = x - shift
+    moments = np.mean(np.stack((shifted, shifted * shifted)),
+                      tuple(i + 1 for i in axis), keepdims=True)
+    mean, mean_of_squares = moments[0], moments[1]
+    return shift + mean, np.maximum(mean_of_squares - mean ** 2, 0.)
+
+
+def LayerNorm(axis=-1, epsilon=1e-5, center=True, scale=True, beta_init=zeros, gamma_init=ones):
+    """Layer construction function for a layer normalization layer, normalizing over `axis`
+    (by default the feature axis) independently for each example."""
+    axis = (axis,) if np.isscalar(axis) else axis
+
+    @parametrized
+    def layer_norm(x):
+        normalized_axis = tuple(i % np.ndim(x) for i in axis)
+        mean, var = _moments(x, normalized_axis)
+        z = (x.astype(mean.dtype) - mean) * lax.rsqrt(var + epsilon)
+
+        ed = tuple(slice(None) if i in normalized_axis else None for i in range(np.ndim(x)))
+        shape = tuple(x.shape[i] for i in normalized_axis)
+        if scale:
+            z = z * parameter(shape, gamma_init, 'gamma')[ed]
+        if center:
+            z = z + parameter(shape, beta_init, 'beta')[ed]
+        return z.astype(x.dtype)
+
+    return layer_norm
+
+
+def GroupNorm(num_groups=32, epsilon=1e-5, center=True, scale=True,
+              beta_init=zeros, gamma_init=ones):
+    """Layer construction function for a group normalization layer, normalizing channels
+    (the last axis) in `num_groups` groups over all but the first (batch) axis."""
+
+    @parametrized
+    def group_norm(x):
+        channels = x.shape[-1]
+        if channels % num_groups != 0:
+            raise ValueError(f'Number of channels ({channels}) must be divisible '
+                             f'by number of groups ({num_groups}).')
+
+        grouped = np.reshape(x, x.shape[:-1] + (num_groups, channels // num_groups))
+        mean, var = _moments(grouped, tuple(range(1, np.ndim(x) - 1)) + (np.ndim(x),))
+        z = (grouped.astype(mean.dtype) - mean) * lax.rsqrt(var + epsilon)
+        z = np.reshape(z, x.shape)
+
+        ed = (None,) * (np.ndim(x) - 1) + (slice(None),)
+        if scale:
+            z = z * parameter((channels,), gamma_init, 'gamma')[ed]
+        if center:
+            z = z + parameter((channels,), beta_init, 'beta')[ed]
+        return z.astype(x.dtype)
+
+    return group_norm
 
 
 def Regularized(loss_model, regularizer):
     @parametrized
     def regularized(*inputs):
         params = Parameter(lambda key: loss_model.init_parameters(*inputs, key=key), 'model')()
+        # running statistics are not trained by gradients, and therefore not regularized:
         regularization_loss = sum(
-            map(lambda param: np.sum(regularizer(param)), tree_leaves(params)))
+            np.sum(regularizer(param)) for param, path
+            in zip(tree_leaves(params), tree_leaves(_parameter_paths(params)))
+            if not _is_running_statistic(path))
         return loss_model.apply(params, *inputs) + regularization_loss
 
     return regularized
@@ -257,3 +859,201 @@ def Batched(unbatched_model: parametrized, batch_dim=0):
         return batched_apply(*batched_args)
 
     return batched
+
+
+KVCache = namedtuple('kv_cache', ('keys', 'values', 'length'))
+KVCache.__doc__ = """Preallocated keys and values of shape (batch, max_length, heads, head_size)
+for autoregressive decoding with `MultiHeadAttention`, filled up to `length`."""
+
+
+def _attention(queries, keys, values, causal, chunk_size=None, query_offset=0, key_length=None):
+    """Dot-product attention over inputs of shape (batch, time, heads, head_size).
+    Queries and keys are processed in blocks of `chunk_size` (or all at once if `None`),
+    normalizing with an online softmax, so that scores are never materialized for all pairs."""
+
+    queries = queries / np.sqrt(queries.shape[-1])
+    key_length = keys.shape[1] if key_length is None else key_length
+    query_chunk_size = chunk_size or queries.shape[1]
+    key_chunk_size = chunk_size or keys.shape[1]
+
+    def blocks(x, size):
+        padded_length = -(-x.shape[1] // size) * size
+        x = np.pad(x, [(0, 0), (0, padded_length - x.shape[1])] + [(0, 0)] * (x.ndim - 2),
+                   mode='constant')
+        return np.swapaxes(np.reshape(x, (x.shape[0], -1, size) + x.shape[2:]), 0, 1)
+
+    key_blocks, value_blocks = blocks(keys, key_chunk_size), blocks(values, key_chunk_size)
+    key_position_blocks = np.reshape(np.arange(key_blocks.shape[0] * key_chunk_size),
+                                     (-1, key_chunk_size))
+
+    def attend(query_block_and_positions):
+        query_block, query_positions = query_block_and_positions
+
+        def step(carry, key_value_block):
+            maximum, normalizer, accumulator = carry
+            key_block, value_block, key_positions = key_value_block
+            mask = np.broadcast_to(key_positions < key_length,
+                                   query_positions.shape + key_positions.shape)
+            if causal:
+                mask = mask & (key_positions <= query_positions[:, None])
+            mask = mask[:, None, :]
+            scores = np.where(mask, np.einsum('bqhd,bkhd->bqhk', query_block, key_block), -1e30)
+            new_maximum = np.maximum(maximum, np.max(scores, axis=-1))
+            weights = np.exp(scores - new_maximum[..., None]) * mask
+            correction = np.exp(maximum - new_maximum)
+            normalizer = normalizer * correction + np.sum(weights, axis=-1)
+            accumulator = (accumulator * correction[..., None] +
+                           np.einsum('bqhk,bkhd->bqhd', weights, value_block))
+            return (new_maximum, normalizer, accumulator), ()
+
+        shape = query_block.shape[:-1]
+        init = np.full(shape, -1e30), np.zeros(shape), np.zeros(query_block.shape)
+        (_, normalizer, accumulator), _ = lax.scan(
+            step, init, (key_blocks, value_blocks, key_position_blocks))
+        return accumulator / normalizer[..., None]
+
+    query_blocks = blocks(queries, query_chunk_size)
+    query_position_blocks = query_offset + np.reshape(
+        np.arange(query_blocks.shape[0] * query_chunk_size), (-1, query_chunk_size))
+    outputs = lax.map(attend, (query_blocks, query_position_blocks))
+    outputs = np.reshape(np.swapaxes(outputs, 0, 1), (queries.shape[0], -1) + queries.shape[2:])
+    return outputs[:, :queries.shape[1]]
+
+
+def MultiHeadAttention(num_heads, head_size, causal=False, chunk_size=None,
+                       kernel_init=glorot_normal(), bias_init=zeros):
+    """Layer construction function for multi-head dot-product attention.
+    Expecting queries of shape (batch, time, channels) and optionally a memory
+    of shape (batch, memory_time, memory_channels) to attend to, defaulting to self-attention.
+    With `chunk_size`, attention is computed over blocks of queries and keys,
+    so that memory grows linearly instead of quadratically with sequence length.
+
+    For autoregressive decoding, `attention.decode(params, cache, x)` causally attends from
+    new time steps `x` of shape (batch, steps, channels) to all previous ones,
+    stored in a `KVCache` from `attention.init_cache(batch_size, max_length)`,
+    and returns the updated cache and the outputs. It can be jitted."""
+
+    def heads(x, kernel):
+        return np.reshape(np.dot(x, kernel), x.shape[:-1] + (num_heads, head_size))
+
+    def merge_heads(x):
+        return np.reshape(x, x.shape[:-2] + (num_heads * head_size,))
+
+    @parametrized
+    def multi_head_attention(queries, memory=None):
+        memory = queries if memory is None else memory
+        size = num_heads * head_size
+        query_kernel = parameter((queries.shape[-1], size), kernel_init, 'query_kernel')
+        key_kernel = parameter((memory.shape[-1], size), kernel_init, 'key_kernel')
+        value_kernel = parameter((memory.shape[-1], size), kernel_init, 'value_kernel')
+        attended = _attention(heads(queries, query_kernel), heads(memory, key_kernel),
+                              heads(memory, value_kernel), causal, chunk_size)
+        output_kernel = parameter((size, queries.shape[-1]), kernel_init, 'output_kernel')
+        output_bias = parameter((queries.shape[-1],), bias_init, 'output_bias')
+        return np.dot(merge_heads(attended), output_kernel) + output_bias
+
+    def init_cache(batch_size, max_length):
+        shape = (batch_size, max_length, num_heads, head_size)
+        return KVCache(np.zeros(shape), np.zeros(shape), np.zeros((), 'int32'))
+
+    def decode(params, cache, x):
+        start = (0, cache.length, 0, 0)
+        keys = lax.dynamic_update_slice(cache.keys, heads(x, params.key_kernel), start)
+        values = lax.dynamic_update_slice(cache.values, heads(x, params.value_kernel), start)
+        length = cache.length + x.shape[1]
+        attended = _attention(heads(x, params.query_kernel), keys, values, causal=True,
+                              query_offset=cache.length, key_length=length)
+        outputs = np.dot(merge_heads(attended), params.output_kernel) + params.output_bias
+        return KVCache(keys, values, length), outputs
+
+    multi_head_attention.init_cache = init_cache
+    multi_head_attention.decode = decode
+    return multi_head_attention
+
+
+MoEMetrics = namedtuple('moe_metrics', ('load_balancing_loss', 'dropped_fraction'))
+MoEMetrics.__doc__ = """`load_balancing_loss` is minimal (1) for uniform routing and can be added
+to the training loss, scaled by a small factor. `dropped_fraction` is the fraction of
+token-to-expert assignments that exceeded the expert's capacity."""
+
+
+def _one_hot(indices, size):
+    return np.array(indices[..., None] == np.arange(size), 'float32')
+
+
+def MoE(expert_factory, num_experts, k=1, capacity_factor=1.25, return_metrics=False):
+    """Sparse mixture of experts layer, expecting inputs of shape (..., channels).
+    Each token is routed to its top `k` out of `num_experts` experts, created by a single
+    `expert_factory()` call, and weighted by the router probability (renormalized for k > 1).
+    Expert parameters are stacked, and all experts are applied as one batched computation
+    to at most `ceil(k * tokens * capacity_factor / num_experts)` tokens each, which are
+    gathered into and combined from the experts by slot index, at a cost linear in tokens.
+    Assignments beyond an expert's capacity are dropped.
+    With `return_metrics`, also returns `MoEMetrics`."""
+
+    expert = expert_factory()
+
+    @parametrized
+    def moe(inputs):
+        x = np.reshape(inputs, (-1, inputs.shape[-1]))
+        tokens = x.shape[0]
+        capacity = int(math.ceil(k * tokens * capacity_factor / num_experts))
+        probs = softmax(Dense(num_experts)(x))
+
+        masks, remaining = [], probs
+        for _ in range(k):
+            mask = _one_hot(np.argmax(remaining, axis=-1), num_experts)
+            remaining = remaining * (1 - mask)
+            masks.append(mask)
+
+        gates = [np.sum(probs * mask, axis=-1) for mask in masks]
+        if k > 1:
+            total = sum(gates)
+            gates = [gate / total for gate in gates]
+
+        slots = _expert_slots(masks, capacity)
+        dropped_slot = num_experts * capacity
+        # one extra slot collects dropped assignments:
+        buffer = np.zeros((dropped_slot + 1, x.shape[-1]), x.dtype)
+        for token_slots in slots:
+            buffer = index_add(buffer, token_slots, x)
+        expert_inputs = np.reshape(buffer[:-1], (num_experts, capacity, x.shape[-1]))
+        params = Parameter(lambda key: _stacked_parameters(expert, num_experts, expert_inputs[0],
+                                                           key), 'experts')()
+        expert_outputs = vmap(expert.apply)(params, expert_inputs)
+        expert_outputs = np.reshape(expert_outputs, (dropped_slot, -1))
+        expert_outputs = np.concatenate((expert_outputs, np.zeros_like(expert_outputs[:1])))
+        outputs = sum(gate[:, None] * expert_outputs[token_slots]
+                      for token_slots, gate in zip(slots, gates))
+        outputs = np.reshape(outputs, inputs.shape[:-1] + outputs.shape[-1:])
+        if not return_metrics:
+            return outputs
+
+        load = np.mean(masks[0], axis=0)
+        importance = np.mean(probs, axis=0)
+        return outputs, MoEMetrics(load_balancing_loss=num_experts * np.sum(load * importance),
+                                   dropped_fraction=np.mean(np.stack(slots) == dropped_slot))
+
+    return moe
+
+
+def _expert_slots(masks, capacity):
+    """For each of the `k` expert assignments (one-hot `masks` of shape (tokens, experts)),
+    returns the index `expert * capacity + position` of each token's slot in the flattened
+    expert inputs, or `experts * capacity` for assignments dropped beyond capacity.
+    Slots are filled in token order, first assignments first."""
+    num_experts = masks[0].shape[-1]
+    counts = np.zeros((num_experts,))
+    slots = []
+    for mask in masks:
+        positions = np.sum((np.cumsum(mask, axis=0) - 1 + counts) * mask, axis=-1)
+        counts = counts + np.sum(mask, axis=0)
+        experts = np.argmax(mask, axis=-1)
+        slots.append(np.where(positions < capacity, experts * capacity + positions,
+                              num_experts * capacity).astype('int32'))
+    return slots
+
+
+def _stacked_parameters(model, count, example_inputs, key):
+    params = [model.init_parameters(example_inputs, key=key) for key in random.split(key, count)]
+    return tree_multimap(lambda *ps: np.stack(ps), *params)
@@ -1,15 +1,21 @@
 from abc import ABC, abstractmethod
 from collections import namedtuple
-from functools import lru_cache
+from functools import lru_cache, partial
 
 import jax
-from jax import grad, value_and_grad, tree_map, tree_multimap, partial
+from jax import numpy as np, lax, value_and_grad, tree_map, tree_multimap, tree_flatten, \
+    tree_unflatten, tree_leaves, vmap, eval_shape
+from jax.core import Tracer, trace_state
 from jax.experimental import optimizers as experimental
 # noinspection PyUnresolvedReferences
 from jax.experimental.optimizers import constant, exponential_decay, inverse_time_decay, \
     polynomial_decay, piecewise_constant
 
+from jaxnet.core import _child_path, _parameter_paths
+from jaxnet.modules import update_running_statistics, _is_running_statistic
+
 State = namedtuple('optimizer', ('step', 'values'))
+Statistics = namedtuple('statistics', ('gradient_norm', 'update_norm'))
 
 
 class Optimizer(ABC):
@@ -21,25 +27,48 @@ class Optimizer(ABC):
     """
 
     def init(self, parameters):
-        return State(0, tree_map(self._init_for_parameter, parameters))
+        return State(0, tree_multimap(lambda parameter, path: self._init_for_parameter_at(
+            path, parameter), parameters, _parameter_paths(parameters)))
 
     def update_from_gradients(self, gradients, state):
         step, _state = state
-        return State(step + 1,
-                     tree_multimap(partial(self._update_for_parameter, step), gradients, _state))
+        gradients = self._transform_gradients(gradients)
+        return State(step + 1, tree_multimap(
+            lambda gradient, path, state:
+            self._update_for_parameter_at(step, path, gradient, state),
+            gradients, _parameter_paths(gradients), _state))
 
-    def get_parameters(self, state):
+    def get_parameters(self, state, averaged=False):
+        """With `averaged`, returns the parameter averages maintained by an `Averaged` optimizer
+        instead of the parameters themselves."""
         _, state = state
+        get_parameter_at = self._get_average_at if averaged else self._get_parameter_at
 
-        def _get_parameters(state):
+        def _get_parameters(state, path):
             # assumes state is non-nested (named)tuple of numpy arrays for each parameter:
             if all(map(lambda n: isinstance(n, jax.numpy.ndarray), state)) and len(state) > 0:
-                return self._get_parameter(state)
+                return get_parameter_at(path, state)
 
             # TODO assumes parameters to be a nested (named)tuple / list:
-            return type(state)(*map(_get_parameters, state))
+            names = getattr(state, '_fields', range(len(state)))
+            return type(state)(*(_get_parameters(s, _child_path(path, name))
+                                 for name, s in zip(names, state)))
+
+        return _get_parameters(state, '')
+
+    def set_parameters(self, state, parameters):
+        """Returns `state` with its parameters replaced, keeping the remaining optimizer state,
+        for example to store running statistics from `update_running_statistics`."""
+        step, state = state
+
+        def _set_parameters(state, parameters):
+            # assumes the parameter to be the first component of each parameter's state:
+            if all(map(lambda n: isinstance(n, jax.numpy.ndarray), state)) and len(state) > 0:
+                return type(state)(parameters, *state[1:])
 
-        return _get_parameters(state)
+            return type(state)(*map(_set_parameters, state, parameters))
+
+        return State(step, _set_parameters(state, parameters))
 
     def get_step(self, state):
         step, _ = state
@@ -51,24 +80,157 @@ class Optimizer(ABC):
     def update_and_get_loss(self, loss_fun, state, *inputs, jit=False, **kwargs):
         return self._update(loss_fun, state, *inputs, **kwargs, jit=jit, return_loss=True)
 
-    def _update(self, loss_fun, state, *inputs, jit=False, return_loss=False, **kwargs):
-        inner = self._update_fun(loss_fun, return_loss=return_loss)
+    def update_and_get_statistics(self, loss_fun, state, *inputs, jit=False, **kwargs):
+        """Like `update_and_get_loss`, but also returns `Statistics` with the global norms of
+        the gradient and the parameter update, computed on device within the same call."""
+        return self._update(loss_fun, state, *inputs, **kwargs, jit=jit, return_loss=True,
+                            return_statistics=True)
+
+    def update_with_running_statistics(self, loss, state, *inputs, jit=False, **kwargs):
+        """Like `update_and_get_loss(loss.apply, state, *inputs)` for a `parametrized` `loss`,
+        but also updates the running statistics of all `BatchNorm`s (with `momentum`) in `loss`
+        from the batch statistics computed in the same forward pass,
+        see `update_running_statistics`."""
+        inner = self._running_statistics_update_fun(loss)
+        return (jax.jit(inner) if jit else inner)(state, *inputs, **kwargs)
+
+    def update_truncated(self, loss_fun, state, carry, *sequences, window_length, jit=False,
+                         remat=False):
+        """Truncated backpropagation through time over `sequences` of shape (batch, time, ...).
+        They are split into windows of `window_length` steps, with one update per window.
+        `loss_fun(parameters, carry, *windows)` has to return `(loss, carry)`,
+        for example using an `Rnn` with `return_carry=True`. The carry is passed on to the
+        next window, but gradients are stopped between windows, so that memory does not grow
+        with the sequence length. With `remat`, activations within a window are recomputed
+        in the backward pass instead of being stored.
+        Returns the new state, the losses of all windows and the final carry."""
+        length = sequences[0].shape[1]
+        inner = self._truncated_update_fun(loss_fun, remat=remat)
+        inner = jax.jit(inner) if jit else inner
+        losses = []
+        for start in range(0, length, window_length):
+            windows = [sequence[:, start:start + window_length] for sequence in sequences]
+            state, loss, carry = inner(state, carry, *windows)
+            losses.append(loss)
+
+        return state, np.stack(losses), carry
+
+    def _update(self, loss_fun, state, *inputs, jit=False, return_loss=False,
+                return_statistics=False, **kwargs):
+        inner = self._update_fun(loss_fun, return_loss=return_loss,
+                                 return_statistics=return_statistics)
         return (jax.jit(inner) if jit else inner)(state, *inputs, **kwargs)
 
     # To avoid recompilation on every call:
     @lru_cache()
-    def _update_fun(self, loss_fun, return_loss=False):
+    def _update_fun(self, loss_fun, return_loss=False, return_statistics=False):
         def update(state, *inputs, **kwargs):
             params = self.get_parameters(state)
-            if return_loss:
-                loss, gradient = value_and_grad(loss_fun)(params, *inputs, **kwargs)
-                return self.update_from_gradients(gradient, state), loss
-            else:
-                gradient = grad(loss_fun)(params, *inputs, **kwargs)
-                return self.update_from_gradients(gradient, state)
+            loss, gradient = self._value_and_grad(loss_fun, params, inputs, kwargs)
+            new_state = self.update_from_gradients(gradient, state)
+            if return_statistics:
+                return new_state, loss, _statistics(gradient, params,
+                                                    self.get_parameters(new_state))
+
+            return (new_state, loss) if return_loss else new_state
 
         return update
 
+    def _value_and_grad(self, loss_fun, parameters, inputs, kwargs, has_aux=False):
+        """Like `value_and_grad`, but gradients of frozen parameters (see `_is_trainable_at`)
+        are not computed and zero instead, so that step time scales with trainable parameters."""
+        leaves, tree = tree_flatten(parameters)
+        is_trainable = [self._is_trainable_at(path)
+                        for path in tree_leaves(_parameter_paths(parameters))]
+        if all(is_trainable):
+            return value_and_grad(loss_fun, has_aux=has_aux)(parameters, *inputs, **kwargs)
+
+        def trainable_loss(trainable_leaves):
+            trainable_leaves = iter(trainable_leaves)
+            return loss_fun(tree_unflatten(tree, [
+                next(trainable_leaves) if trainable else lax.stop_gradient(leaf)
+                for leaf, trainable in zip(leaves, is_trainable)]), *inputs, **kwargs)
+
+        value, gradients = value_and_grad(trainable_loss, has_aux=has_aux)(
+            [leaf for leaf, trainable in zip(leaves, is_trainable) if trainable])
+        gradients = iter(gradients)
+        return value, tree_unflatten(tree, [next(gradients) if trainable else np.zeros_like(leaf)
+                                            for leaf, trainable in zip(leaves, is_trainable)])
+
+    @lru_cache()
+    def _running_statistics_update_fun(self, loss):
+        def update(state, *inputs, **kwargs):
+            params = self.get_parameters(state)
+            (loss_value, updated), gradient = self._value_and_grad(
+                partial(update_running_statistics, loss), params, inputs, kwargs, has_aux=True)
+            new_state = self.update_from_gradients(gradient, state)
+            new_params = tree_multimap(
+                lambda parameter, updated, path:
+                updated if _is_running_statistic(path) else parameter,
+                self.get_parameters(new_state), updated, _parameter_paths(updated))
+            return self.set_parameters(new_state, new_params), loss_value
+
+        return update
+
+    @lru_cache()
+    def _truncated_update_fun(self, loss_fun, remat=False):
+        if remat:
+            loss_fun = jax.checkpoint(loss_fun)
+
+        def update(state, carry, *windows):
+            params = self.get_parameters(state)
+            (loss, carry), gradient = self._value_and_grad(
+                loss_fun, params, (lax.stop_gradient(carry), *windows), {}, has_aux=True)
+            return self.update_from_gradients(gradient, state), loss, lax.stop_gradient(carry)
+
+        return update
+
+    @staticmethod
+    @lru_cache()
+    def _ParameterState(name, *names):
+        # Cached so that equally configured optimizers share state types, keeping them jit-stable:
+        return namedtuple(name, names)
+
+    # The `_at` variants are also given the path of the parameter, such as
+    # 'sequential/dense0/kernel'. Override them to treat parameters differently by path.
+
+    def _init_for_parameter_at(self, path, parameter):
+        if not self._is_trainable_at(path):
+            return self._ParameterState('frozen', _PARAMETER)(parameter)
+
+        return self._init_for_parameter(parameter)
+
+    def _update_for_parameter_at(self, step, path, gradient, state):
+        if not self._is_trainable_at(path):
+            return state
+
+        return self._update_for_parameter(step, gradient, state)
+
+    def _get_parameter_at(self, path, state):
+        if not self._is_trainable_at(path):
+            parameter, = state
+            return parameter
+
+        return self._get_parameter(state)
+
+    def _get_average_at(self, path, state):
+        raise ValueError('Parameter averages are only maintained by `Averaged` optimizers.')
+
+    def _is_trainable_at(self, path):
+        """False for parameters that are frozen, which are neither differentiated nor updated,
+        and have no optimizer state beyond the parameter itself.
+        Running statistics of `BatchNorm`s are always frozen."""
+        return not _is_running_statistic(path)
+
+    # Transforms of the whole gradient tree, such as clipping by global norm, before the updates
+    # of the individual parameters. `_transforms_gradients` tells whether there are any.
+
+    def _transform_gradients(self, gradients):
+        return gradients
+
+    def _transforms_gradients(self):
+        return False
+
     @abstractmethod
     def _init_for_parameter(self, parameter):
         raise NotImplementedError
@@ -82,6 +244,12 @@ class Optimizer(ABC):
         raise NotImplementedError
 
 
+def _statistics(gradients, parameters, new_parameters):
+    return Statistics(gradient_norm=experimental.l2_norm(gradients),
+                      update_norm=experimental.l2_norm(
+                          tree_multimap(lambda new, old: new - old, new_parameters, parameters)))
+
+
 _PARAMETER = 'parameter'
 
 
@@ -111,8 +279,8 @@ class OptimizerFromExperimental(Optimizer):
         self._inner_init, self._inner_update, self._inner_get_parameter = \
             experimental_optimizer.__wrapped__(*args)
 
-        self.ParameterState = namedtuple(experimental_optimizer.__name__,
-                                         state_component_names)
+        self.ParameterState = self._ParameterState(experimental_optimizer.__name__,
+                                                   *state_component_names)
 
     def _init_for_parameter(self, parameter):
         return self.ParameterState(*self._inner_init(parameter))
@@ -154,9 +322,8 @@ class Sm3(Optimizer):
         self._inner_init, self._inner_update, self._inner_get_parameter = \
             experimental.sm3.__wrapped__(step_size, momentum)
 
-    @lru_cache()
     def ParameterState(self, shape):
-        return namedtuple('sm3', (_PARAMETER, 'm', *(f'v{i}' for i in range(len(shape)))))
+        return self._ParameterState('sm3', _PARAMETER, 'm', *(f'v{i}' for i in range(len(shape))))
 
     def _init_for_parameter(self, parameter):
         x, m, vs = self._inner_init(parameter)
@@ -169,3 +336,817 @@ class Sm3(Optimizer):
 
     def _get_parameter(self, state):
         return state[0]
+
+
+class Adafactor(Optimizer):
+    """
+    Adafactor: Adaptive Learning Rates with Sublinear Memory Cost.
+    https://arxiv.org/abs/1804.04235
+
+    For parameters with at least two dimensions that are both at least
+    `min_dim_size_to_factor` large, the second moment is stored factored
+    as row and column statistics over the last two dimensions,
+    requiring memory of O(n + m) instead of O(n * m) for an n x m matrix.
+    Without `step_size`, the relative step size min(1e-2, 1 / sqrt(step)) is used.
+    With `relative_step`, step sizes are scaled by the root mean square of the parameter.
+    Updates are clipped to a root mean square of `clipping_threshold`, unless it is None.
+    """
+
+    def __init__(self, step_size=None, decay_rate=0.8, momentum=None, clipping_threshold=1.,
+                 relative_step=True, eps1=1e-30, eps2=1e-3, min_dim_size_to_factor=128):
+        self.step_size = experimental.make_schedule(step_size) if step_size is not None else \
+            lambda step: np.minimum(1e-2, 1 / np.sqrt(step + 1))
+        self.decay_rate = decay_rate
+        self.momentum = momentum
+        self.clipping_threshold = clipping_threshold
+        self.relative_step = relative_step
+        self.eps1 = eps1
+        self.eps2 = eps2
+        self.min_dim_size_to_factor = min_dim_size_to_factor
+
+    def _is_factored(self, shape):
+        return len(shape) >= 2 and min(shape[-2:]) >= self.min_dim_size_to_factor
+
+    def ParameterState(self, shape):
+        moments = ('v_row', 'v_col') if self._is_factored(shape) else ('v',)
+        return self._ParameterState('adafactor', _PARAMETER,
+                                    *(('m',) if self.momentum else ()), *moments)
+
+    def _init_for_parameter(self, parameter):
+        shape = parameter.shape
+        m = (np.zeros_like(parameter),) if self.momentum else ()
+        v = (np.zeros(shape[:-1]), np.zeros(shape[:-2] + shape[-1:])) \
+            if self._is_factored(shape) else (np.zeros_like(parameter),)
+        return self.ParameterState(shape)(parameter, *m, *v)
+
+    def _update_for_parameter(self, step, gradient, state):
+        x, *moments = state
+        m, v = (moments[:1], moments[1:]) if self.momentum else ((), moments)
+        decay = 1 - (step + 1.) ** -self.decay_rate
+        g_sq = gradient ** 2 + self.eps1
+
+        if self._is_factored(gradient.shape):
+            v_row, v_col = v
+            v_row = decay * v_row + (1 - decay) * np.mean(g_sq, -1)
+            v_col = decay * v_col + (1 - decay) * np.mean(g_sq, -2)
+            row_factor = v_row / np.mean(v_row, -1, keepdims=True)
+            update = gradient / np.sqrt(row_factor[..., None] * v_col[..., None, :])
+            v = v_row, v_col
+        else:
+            v, = v
+            v = decay * v + (1 - decay) * g_sq
+            update = gradient / np.sqrt(v)
+            v = v,
+
+        if self.clipping_threshold is not None:
+            update = update / np.maximum(1., _rms(update) / self.clipping_threshold)
+
+        step_size = self.step_size(step)
+        if self.relative_step:
+            step_size = np.maximum(self.eps2, _rms(x)) * step_size
+
+        if self.momentum:
+            m = tuple(self.momentum * m_ + (1 - self.momentum) * update for m_ in m)
+            update, = m
+
+        return self.ParameterState(gradient.shape)(x - step_size * update, *m, *v)
+
+    def _get_parameter(self, state):
+        return state[0]
+
+
+def _rms(x):
+    return np.sqrt(np.mean(x ** 2))
+
+
+def _is_bias_or_normalization(path):
+    return path.split('/')[-1] in ('bias', 'beta', 'gamma') or _is_running_statistic(path)
+
+
+class _LayerwiseAdaptive(Optimizer):
+    """
+    Shared base for optimizers that scale the update of each parameter array (e. g. the kernel
+    of each `dense` layer) by a trust ratio of parameter norm to update norm.
+    Parameters whose path (such as 'sequential/dense0/bias') satisfies `exclude`
+    are neither adapted nor decayed. By default, biases and normalization parameters are excluded.
+    """
+
+    def __init__(self, weight_decay, exclude):
+        self.weight_decay = weight_decay
+        self.exclude = exclude or (lambda path: False)
+
+    def _update_for_parameter_at(self, step, path, gradient, state):
+        if not self._is_trainable_at(path):
+            return state
+
+        return self._update_for_parameter(step, gradient, state, excluded=self.exclude(path))
+
+    def _decayed(self, update, parameter, excluded):
+        return update if excluded else update + self.weight_decay * parameter
+
+    @staticmethod
+    def _trust_ratio(parameter, update, excluded, trust_coefficient=1., eps=0.):
+        if excluded:
+            return 1.
+
+        parameter_norm = np.linalg.norm(parameter)
+        update_norm = np.linalg.norm(update)
+        return np.where((parameter_norm > 0) & (update_norm > 0),
+                        trust_coefficient * parameter_norm / (update_norm + eps), 1.)
+
+    def _get_parameter(self, state):
+        return state[0]
+
+
+class Lars(_LayerwiseAdaptive):
+    """
+    Large Batch Training of Convolutional Networks.
+    https://arxiv.org/abs/1708.03888
+    """
+
+    def __init__(self, step_size, momentum=0.9, weight_decay=0., trust_coefficient=1e-3, eps=0.,
+                 exclude=_is_bias_or_normalization):
+        super().__init__(weight_decay, exclude)
+        self.step_size = experimental.make_schedule(step_size)
+        self.momentum = momentum
+        self.trust_coefficient = trust_coefficient
+        self.eps = eps
+        self.ParameterState = self._ParameterState('lars', _PARAMETER, 'velocity')
+
+    def _init_for_parameter(self, parameter):
+        return self.ParameterState(parameter, np.zeros_like(parameter))
+
+    def _update_for_parameter(self, step, gradient, state, excluded=False):
+        x, velocity = state
+        update = self._decayed(gradient, x, excluded)
+        trust_ratio = self._trust_ratio(x, update, excluded, self.trust_coefficient, self.eps)
+        velocity = self.momentum * velocity + self.step_size(step) * trust_ratio * update
+        return self.ParameterState(x - velocity, velocity)
+
+
+class Lamb(_LayerwiseAdaptive):
+    """
+    Large Batch Optimization for Deep Learning: Training BERT in 76 minutes.
+    https://arxiv.org/abs/1904.00962
+    """
+
+    def __init__(self, step_size=0.001, b1=0.9, b2=0.999, eps=1e-6, weight_decay=0.,
+                 exclude=_is_bias_or_normalization):
+        super().__init__(weight_decay, exclude)
+        self.step_size = experimental.make_schedule(step_size)
+        self.b1 = b1
+        self.b2 = b2
+        self.eps = eps
+        self.ParameterState = self._ParameterState('lamb', _PARAMETER, 'm', 'v')
+
+    def _init_for_parameter(self, parameter):
+        return self.ParameterState(parameter, np.zeros_like(parameter), np.zeros_like(parameter))
+
+    def _update_for_parameter(self, step, gradient, state, excluded=False):
+        x, m, v = state
+        m = (1 - self.b1) * gradient + self.b1 * m
+        v = (1 - self.b2) * gradient ** 2 + self.b2 * v
+        mhat = m / (1 - self.b1 ** (step + 1))
+        vhat = v / (1 - self.b2 ** (step + 1))
+        update = self._decayed(mhat / (np.sqrt(vhat) + self.eps), x, excluded)
+        trust_ratio = self._trust_ratio(x, update, excluded)
+        return self.ParameterState(x - self.step_size(step) * trust_ratio * update, m, v)
+
+
+class _Wrapper(Optimizer):
+    """Shared base for optimizers that delegate to `self.optimizer` (or other optimizers),
+    implementing the path-aware `_at` variants only."""
+
+    def _init_for_parameter_at(self, path, parameter):
+        return self.optimizer._init_for_parameter_at(path, parameter)
+
+    def _update_for_parameter_at(self, step, path, gradient, state):
+        return self.optimizer._update_for_parameter_at(step, path, gradient, state)
+
+    def _get_parameter_at(self, path, state):
+        return self.optimizer._get_parameter_at(path, state)
+
+    def _get_average_at(self, path, state):
+        return self.optimizer._get_average_at(path, state)
+
+    def _is_trainable_at(self, path):
+        return self.optimizer._is_trainable_at(path)
+
+    def _transform_gradients(self, gradients):
+        return self.optimizer._transform_gradients(gradients)
+
+    def _transforms_gradients(self):
+        return self.optimizer._transforms_gradients()
+
+    def _init_for_parameter(self, parameter):
+        return self._init_for_parameter_at('', parameter)
+
+    def _update_for_parameter(self, step, gradient, state):
+        return self._update_for_parameter_at(step, '', gradient, state)
+
+    def _get_parameter(self, state):
+        return self._get_parameter_at('', state)
+
+
+# octaves below the block maximum that are representable, smaller magnitudes are stored as 0:
+_SIGNED_OCTAVES = 12
+_NON_NEGATIVE_OCTAVES = 32
+
+
+def _quantize(x, block_size):
+    """Quantizes `x` to int8 in blocks of `block_size` consecutive elements, each with a scale.
+    Magnitudes are stored logarithmically relative to the block maximum, giving constant relative
+    precision over many orders of magnitude, as needed for second moments. Signed blocks use
+    a sign bit and 127 magnitude levels, blocks without negative values use all 255 levels,
+    which is indicated by a negated scale."""
+    size = x.size
+    blocks = np.reshape(np.pad(np.ravel(x), (0, -size % block_size), mode='constant'),
+                        (-1, block_size))
+    scales = np.max(np.abs(blocks), axis=1)
+    normalized = blocks / np.where(scales > 0, scales, 1)[:, None]
+    log_magnitude = np.log2(np.abs(normalized))
+    non_negative = np.all(blocks >= 0, axis=1)[:, None]
+    signed_q = np.sign(normalized) * np.clip(
+        np.round(127 + log_magnitude * 126 / _SIGNED_OCTAVES), 0, 127)
+    non_negative_q = np.clip(
+        np.round(255 + log_magnitude * 254 / _NON_NEGATIVE_OCTAVES), 0, 255) - 128
+    q = np.where(non_negative, non_negative_q, signed_q)
+    scales = np.where(non_negative[:, 0], -scales, scales)
+    return np.reshape(np.ravel(q)[:size], x.shape).astype(np.int8), scales
+
+
+def _dequantize(q, scales, block_size):
+    size = q.size
+    blocks = np.reshape(np.pad(np.ravel(q).astype(np.float32), (0, -size % block_size),
+                               mode='constant'), (-1, block_size))
+    non_negative = (scales < 0)[:, None]
+    signed = np.where(blocks == 0, 0, np.sign(blocks) * 2 ** (
+            (np.abs(blocks) - 127) * _SIGNED_OCTAVES / 126))
+    non_negative_levels = blocks + 128
+    non_negative_x = np.where(non_negative_levels == 0, 0, 2 ** (
+            (non_negative_levels - 255) * _NON_NEGATIVE_OCTAVES / 254))
+    x = np.where(non_negative, non_negative_x, signed) * np.abs(scales)[:, None]
+    return np.reshape(np.ravel(x)[:size], q.shape)
+
+
+class CompressedState(_Wrapper):
+    """
+    Wraps an optimizer to store its state, except for the parameters themselves,
+    in reduced precision, for example Adam's `m` and `v`:
+    ```
+        opt = CompressedState(Adam(), precision='int8')
+    ```
+    With 'bfloat16', state takes half the memory.
+    With 'int8', state is blockwise quantized, taking about a quarter of the memory,
+    with an additional float32 scale per block of `block_size` elements.
+    State is decompressed and recompressed within the update.
+    """
+
+    def __init__(self, optimizer, precision='int8', block_size=256):
+        if precision not in ('int8', 'bfloat16'):
+            raise ValueError(f"Precision must be 'int8' or 'bfloat16', not {precision}.")
+
+        self.optimizer = optimizer
+        self.precision = precision
+        self.block_size = block_size
+
+    def _compress(self, state):
+        names, values = [], []
+        for name, value in zip(state._fields, state):
+            if name == _PARAMETER:
+                names.append(name)
+                values.append(value)
+            elif self.precision == 'bfloat16':
+                names.append(name)
+                values.append(value.astype(np.bfloat16))
+            else:
+                names += [name, f'{name}_scale']
+                values += _quantize(value, self.block_size)
+
+        return self._ParameterState(type(state).__name__, *names)(*values)
+
+    def _decompress(self, state):
+        names, values = [], []
+        items = iter(zip(state._fields, state))
+        for name, value in items:
+            names.append(name)
+            if name == _PARAMETER:
+                values.append(value)
+            elif self.precision == 'bfloat16':
+                values.append(value.astype(np.float32))
+            else:
+                _, scales = next(items)
+                values.append(_dequantize(value, scales, self.block_size))
+
+        return self._ParameterState(type(state).__name__, *names)(*values)
+
+    def _init_for_parameter_at(self, path, parameter):
+        return self._compress(self.optimizer._init_for_parameter_at(path, parameter))
+
+    def _update_for_parameter_at(self, step, path, gradient, state):
+        return self._compress(self.optimizer._update_for_parameter_at(
+            step, path, gradient, self._decompress(state)))
+
+    def _get_parameter_at(self, path, state):
+        return self.optimizer._get_parameter_at(path, self._decompress(state))
+
+    def _get_average_at(self, path, state):
+        return self.optimizer._get_average_at(path, self._decompress(state))
+
+
+class WeightDecayed(_Wrapper):
+    """
+    Wraps an optimizer to decay parameters by a factor of `1 - weight_decay` at each step,
+    decoupled from the gradient-based update and fused into it,
+    instead of adding a regularization term to the loss as `L2Regularized` does.
+    `weight_decay` can be a scalar or a schedule.
+    Parameters whose path (such as 'sequential/dense0/bias') satisfies `exclude` are not decayed.
+    By default, biases and normalization parameters are excluded.
+    """
+
+    def __init__(self, optimizer, weight_decay, exclude=_is_bias_or_normalization):
+        self.optimizer = optimizer
+        self.weight_decay = experimental.make_schedule(weight_decay)
+        self.exclude = exclude or (lambda path: False)
+
+    def _update_for_parameter_at(self, step, path, gradient, state):
+        if self._is_trainable_at(path) and not self.exclude(path):
+            decayed = (1 - self.weight_decay(step)) * getattr(state, _PARAMETER)
+            state = state._replace(**{_PARAMETER: decayed})
+
+        return self.optimizer._update_for_parameter_at(step, path, gradient, state)
+
+
+def AdamW(step_size=0.001, b1=0.9, b2=0.999, eps=1e-8, weight_decay=1e-2,
+          exclude=_is_bias_or_normalization):
+    """Adam with decoupled weight decay, scaled by the step size, as in
+    Decoupled Weight Decay Regularization. https://arxiv.org/abs/1711.05101"""
+    step_size = experimental.make_schedule(step_size)
+    return WeightDecayed(Adam(step_size, b1, b2, eps),
+                         lambda step: weight_decay * step_size(step), exclude=exclude)
+
+
+class Clipped(_Wrapper):
+    """
+    Wraps an optimizer to clip gradients within the update, to a global norm
+    of at most `max_global_norm` and/or to a norm of at most `max_norm` for each parameter.
+    Clipping to a global norm is not supported within `Grouped` or as `KFac` fallback,
+    since these update parameters separately.
+    """
+
+    def __init__(self, optimizer, max_global_norm=None, max_norm=None):
+        self.optimizer = optimizer
+        self.max_global_norm = max_global_norm
+        self.max_norm = max_norm
+
+    def _transform_gradients(self, gradients):
+        if self.max_global_norm is not None:
+            gradients = experimental.clip_grads(gradients, self.max_global_norm)
+
+        return self.optimizer._transform_gradients(gradients)
+
+    def _transforms_gradients(self):
+        return self.max_global_norm is not None or self.optimizer._transforms_gradients()
+
+    def _update_for_parameter_at(self, step, path, gradient, state):
+        if self.max_norm is not None:
+            gradient, = experimental.clip_grads((gradient,), self.max_norm)
+
+        return self.optimizer._update_for_parameter_at(step, path, gradient, state)
+
+
+class Averaged(_Wrapper):
+    """
+    Wraps an optimizer to maintain an exponential moving average of the parameters
+    within the optimizer state, updated in the same (compiled) step. Access it via
+    `get_parameters(state, averaged=True)`, for example to evaluate with `apply_from`.
+    The average is stored in `dtype` if given, for example `np.bfloat16` to save memory.
+    """
+
+    def __init__(self, optimizer, decay=0.999, dtype=None):
+        self.optimizer = optimizer
+        self.decay = decay
+        self.dtype = dtype
+
+    def _with_average(self, state, average):
+        return self._ParameterState(type(state).__name__, *state._fields, 'average')(
+            *state, average.astype(self.dtype) if self.dtype else average)
+
+    def _without_average(self, state):
+        return self._ParameterState(type(state).__name__, *state._fields[:-1])(*state[:-1])
+
+    def _init_for_parameter_at(self, path, parameter):
+        state = self.optimizer._init_for_parameter_at(path, parameter)
+        # frozen parameters, such as running statistics, are their own average:
+        return self._with_average(state, parameter) if self._is_trainable_at(path) else state
+
+    def _update_for_parameter_at(self, step, path, gradient, state):
+        if not self._is_trainable_at(path):
+            return self.optimizer._update_for_parameter_at(step, path, gradient, state)
+
+        average = state.average
+        state = self.optimizer._update_for_parameter_at(step, path, gradient,
+                                                        self._without_average(state))
+        parameter = self.optimizer._get_parameter_at(path, state)
+        return self._with_average(state, self.decay * average + (1 - self.decay) * parameter)
+
+    def _get_parameter_at(self, path, state):
+        if not self._is_trainable_at(path):
+            return self.optimizer._get_parameter_at(path, state)
+
+        return self.optimizer._get_parameter_at(path, self._without_average(state))
+
+    def _get_average_at(self, path, state):
+        if not self._is_trainable_at(path):
+            return self.optimizer._get_parameter_at(path, state)
+
+        return state.average.astype(getattr(state, _PARAMETER).dtype)
+
+
+class Sweep(_Wrapper):
+    """
+    Trains one copy of the parameters for each of several hyperparameter configurations
+    in a single program, for example:
+    ```
+        opt = Sweep(Adam, step_size=[1e-3, 3e-4, 1e-4], b1=[.9, .9, .95])
+    ```
+    Hyperparameters are given as equal-length arrays, one entry per configuration.
+    `init` replicates the parameters for each configuration, stacking them along a new
+    leading axis. `update` takes the same (unstacked) loss function as any other optimizer,
+    and `update_and_get_loss` returns a vector of losses, one per configuration.
+    `Sweep` has to be the outermost optimizer: wrap the optimizers returned by
+    `optimizer_factory` instead, for example `Sweep(lambda **h: Averaged(Adam(**h)), ...)`,
+    since wrapping optimizers would pass the stacked parameters to the loss function.
+    """
+
+    def __init__(self, optimizer_factory, **hyperparameters):
+        self._optimizer_factory = optimizer_factory
+        self.hyperparameters = {name: np.asarray(values)
+                                for name, values in hyperparameters.items()}
+
+        lengths = set(len(values) for values in self.hyperparameters.values())
+        if len(lengths) != 1:
+            raise ValueError('Hyperparameters must be arrays of equal length, one entry per '
+                             'configuration.')
+
+        self.num_configs, = lengths
+
+    def _optimizer(self, hyperparameters):
+        return self._optimizer_factory(**hyperparameters)
+
+    def _init_for_parameter_at(self, path, parameter):
+        return vmap(lambda h: self._optimizer(h)._init_for_parameter_at(path, parameter))(
+            self.hyperparameters)
+
+    def _update_for_parameter_at(self, step, path, gradient, state):
+        return vmap(lambda h, g, s: self._optimizer(h)._update_for_parameter_at(step, path, g, s))(
+            self.hyperparameters, gradient, state)
+
+    def _get_parameter_at(self, path, state):
+        return vmap(lambda h, s: self._optimizer(h)._get_parameter_at(path, s))(
+            self.hyperparameters, state)
+
+    def _get_average_at(self, path, state):
+        return vmap(lambda h, s: self._optimizer(h)._get_average_at(path, s))(
+            self.hyperparameters, state)
+
+    def _is_trainable_at(self, path):
+        return self._optimizer(self._first_hyperparameters())._is_trainable_at(path)
+
+    def _transform_gradients(self, gradients):
+        return vmap(lambda h, g: self._optimizer(h)._transform_gradients(g))(
+            self.hyperparameters, gradients)
+
+    def _transforms_gradients(self):
+        return self._optimizer(self._first_hyperparameters())._transforms_gradients()
+
+    def _first_hyperparameters(self):
+        return {name: values[0].item() for name, values in self.hyperparameters.items()}
+
+    @lru_cache()
+    def _update_fun(self, loss_fun, return_loss=False, return_statistics=False):
+        def update(state, *inputs, **kwargs):
+            params = self.get_parameters(state)
+            losses, gradient = vmap(
+                lambda p: self._value_and_grad(loss_fun, p, inputs, kwargs))(params)
+            new_state = self.update_from_gradients(gradient, state)
+            if return_statistics:
+                return new_state, losses, vmap(_statistics)(gradient, params,
+                                                            self.get_parameters(new_state))
+
+            return (new_state, losses) if return_loss else new_state
+
+        return update
+
+    def update_truncated(self, loss_fun, state, carry, *sequences, window_length, jit=False,
+                         remat=False):
+        raise NotImplementedError('Truncated backpropagation through time is not supported for '
+                                  '`Sweep`, which would require one carry per configuration.')
+
+    def update_with_running_statistics(self, loss, state, *inputs, jit=False, **kwargs):
+        raise NotImplementedError('Updating running statistics is not supported for `Sweep`, '
+                                  'which would require statistics per configuration.')
+
+    def unstack(self, state, losses=None):
+        """
+        Splits a sweep state into one `(optimizer, state)` pair per configuration,
+        where each state can be used with the corresponding (conventional) optimizer,
+        e. g. to continue training the best configuration.
+        If `losses` are given, `(optimizer, state, loss)` triples are returned instead.
+        """
+        step, values = state
+        optimizers = [self._optimizer({name: hyperparameter_values[i].item()
+                                       for name, hyperparameter_values
+                                       in self.hyperparameters.items()})
+                      for i in range(self.num_configs)]
+        states = [State(step, tree_map(lambda x: x[i], values))
+                  for i in range(self.num_configs)]
+
+        if losses is None:
+            return list(zip(optimizers, states))
+
+        return list(zip(optimizers, states, losses))
+
+
+class Grouped(_Wrapper):
+    """
+    Optimizes subtrees of the parameters with different optimizers, or freezes them, e. g.
+    ```
+        opt = Grouped(Adam(), {'sequential/dense0': None, 'sequential/dense1': Sgd(.1)})
+    ```
+    Subtrees are specified by their path of field names in the parameters.
+    The longest matching path decides, and `default` is used for all other parameters.
+    Frozen parameters (with optimizer None) have no optimizer state beyond the parameter itself.
+    `update` does not compute their gradients, so that memory and step time scale
+    with the trainable parameters only. They are also left untouched by wrapping optimizers,
+    such as `WeightDecayed`.
+    """
+
+    def __init__(self, default, groups):
+        if any(optimizer is not None and optimizer._transforms_gradients()
+               for optimizer in (default, *groups.values())):
+            raise ValueError('Transforms of the whole gradient tree, such as clipping by '
+                             'global norm, are not supported within `Grouped`, '
+                             'wrap the `Grouped` optimizer instead.')
+
+        self.default = default
+        self.groups = groups
+
+    def _optimizer_at(self, path):
+        matches = [group for group in self.groups
+                   if group == '' or path == group or path.startswith(group + '/')]
+        return self.groups[max(matches, key=len)] if matches else self.default
+
+    def _init_for_parameter_at(self, path, parameter):
+        optimizer = self._optimizer_at(path)
+        if optimizer is None:
+            return self._ParameterState('frozen', _PARAMETER)(parameter)
+
+        return optimizer._init_for_parameter_at(path, parameter)
+
+    def _update_for_parameter_at(self, step, path, gradient, state):
+        optimizer = self._optimizer_at(path)
+        if optimizer is None:
+            return state
+
+        return optimizer._update_for_parameter_at(step, path, gradient, state)
+
+    def _get_parameter_at(self, path, state):
+        optimizer = self._optimizer_at(path)
+        if optimizer is None:
+            parameter, = state
+            return parameter
+
+        return optimizer._get_parameter_at(path, state)
+
+    def _get_average_at(self, path, state):
+        optimizer = self._optimizer_at(path)
+        if optimizer is None:
+            parameter, = state
+            return parameter
+
+        return optimizer._get_average_at(path, state)
+
+    def _is_trainable_at(self, path):
+        optimizer = self._optimizer_at(path)
+        return optimizer is not None and optimizer._is_trainable_at(path)
+
+    def _transform_gradients(self, gradients):
+        return gradients
+
+    def _transforms_gradients(self):
+        return False
+
+
+def _dense_layer_paths(parameters, path=''):
+    """Paths of all `Dense` layers, recognized by their kernel and bias parameters."""
+    if getattr(parameters, '_fields', None) == ('kernel', 'bias') and \
+            np.ndim(parameters.kernel) == 2:
+        return [path]
+
+    if isinstance(parameters, (tuple, list)):
+        names = getattr(parameters, '_fields', range(len(parameters)))
+        return [layer_path for name, p in zip(names, parameters)
+                for layer_path in _dense_layer_paths(p, _child_path(path, name))]
+
+    return []
+
+
+class KFac(Optimizer):
+    """
+    Optimizing Neural Networks with Kronecker-factored Approximate Curvature.
+    https://arxiv.org/abs/1503.05671
+
+    Preconditions the gradients of `Dense` layers with running averages of
+    their input and output-gradient covariances, which are gathered during `update`
+    by intercepting the layer applications. `loss_fun` therefore has to be
+    the `apply` function of a `parametrized` loss (which calls the `Dense` layers as submodules).
+    Inverses of the damped covariances are recomputed every `inverse_update_period` steps.
+    All other parameters are optimized with `fallback`, by default Adam, as are `Dense` layers
+    applied within control flow (such as `lax.scan`), from the first update on.
+    """
+
+    def __init__(self, step_size=0.001, damping=1e-2, decay=0.95, inverse_update_period=10,
+                 fallback=None):
+        self.step_size = experimental.make_schedule(step_size)
+        self.damping = damping
+        self.decay = decay
+        self.inverse_update_period = inverse_update_period
+        self.fallback = fallback or Adam(step_size)
+        if self.fallback._transforms_gradients():
+            raise ValueError('Transforms of the whole gradient tree, such as clipping by '
+                             'global norm, are not supported for the `KFac` fallback.')
+
+        self.KernelState = self._ParameterState(
+            'kfac', _PARAMETER, 'a_factor', 'g_factor', 'a_inverse', 'g_inverse')
+        self.BiasState = self._ParameterState('kfac', _PARAMETER)
+
+    def init(self, parameters):
+        layer_paths = _dense_layer_paths(parameters)
+
+        def init_for_parameter(parameter, path):
+            if path in (_child_path(p, 'kernel') for p in layer_paths):
+                a_eye, g_eye = np.eye(parameter.shape[0] + 1), np.eye(parameter.shape[1])
+                return self.KernelState(parameter, a_eye, g_eye, a_eye, g_eye)
+
+            if path in (_child_path(p, 'bias') for p in layer_paths):
+                return self.BiasState(parameter)
+
+            return self.fallback._init_for_parameter_at(path, parameter)
+
+        return State(0, tree_multimap(init_for_parameter, parameters,
+                                      _parameter_paths(parameters)))
+
+    def _is_own(self, state):
+        return type(state) in (self.KernelState, self.BiasState)
+
+    def _update_for_parameter_at(self, step, path, gradient, state):
+        return self.fallback._update_for_parameter_at(step, path, gradient, state)
+
+    def _get_parameter_at(self, path, state):
+        if self._is_own(state):
+            return getattr(state, _PARAMETER)
+
+        return self.fallback._get_parameter_at(path, state)
+
+    def _update_layer(self, step, kernel_gradient, bias_gradient, kernel_state, bias_state,
+                      inputs, output_gradients):
+        kernel, a_factor, g_factor, a_inverse, g_inverse = kernel_state
+
+        if inputs:
+            a = np.concatenate([np.reshape(x, (-1, x.shape[-1])) for x in inputs])
+            a = np.concatenate((a, np.ones((a.shape[0], 1), a.dtype)), axis=1)
+            g = np.concatenate([np.reshape(g, (-1, g.shape[-1])) for g in output_gradients])
+            batch_size = a.shape[0]
+            # Output gradients are scaled down by the batch size for a mean loss:
+            a_factor = self.decay * a_factor + (1 - self.decay) * np.dot(a.T, a) / batch_size
+            g_factor = self.decay * g_factor + (1 - self.decay) * np.dot(g.T, g) * batch_size
+
+        def inverses(factors):
+            a_factor, g_factor = factors
+            damping = np.sqrt(self.damping)
+            return (np.linalg.inv(a_factor + damping * np.eye(a_factor.shape[0])),
+                    np.linalg.inv(g_factor + damping * np.eye(g_factor.shape[0])))
+
+        a_inverse, g_inverse = lax.cond(step % self.inverse_update_period == 0,
+                                        (a_factor, g_factor), inverses,
+                                        (a_inverse, g_inverse), lambda x: x)
+
+        gradient = np.concatenate((kernel_gradient, bias_gradient[None]), axis=0)
+        update = self.step_size(step) * np.dot(np.dot(a_inverse, gradient), g_inverse)
+        kernel_update, bias_update = update[:-1], update[-1]
+        return (self.KernelState(kernel - kernel_update, a_factor, g_factor, a_inverse, g_inverse),
+                self.BiasState(getattr(bias_state, _PARAMETER) - bias_update))
+
+    @lru_cache()
+    def _update_fun(self, loss_fun, return_loss=False, return_statistics=False):
+        def tapped_loss(params, output_perturbations, inputs, kwargs, taps, nested_paths):
+            """Evaluates the loss, recording layer paths and inputs in `taps` and adding
+            `output_perturbations` (if given) to the outputs of the `Dense` layers,
+            so that their output gradients can be obtained.
+            Layers applied within control flow, such as the body of `lax.scan`, are evaluated
+            repeatedly by their tracer, and only recorded by path in `nested_paths`."""
+            layer_paths = _dense_layer_paths(params)
+            perturbations = iter(output_perturbations or ())
+            # Inputs of layers applied within control flow (or nested transformations)
+            # are traced at a higher level, by traces started after this one:
+            top_level = len(trace_state.trace_stack.upward)
+
+            def interceptor(module, parameters, *module_inputs, path):
+                outputs = module.apply(parameters, *module_inputs)
+                if path not in layer_paths:
+                    return outputs
+
+                if len(module_inputs) != 1 or any(
+                        isinstance(x, Tracer) and x._trace.level >= top_level
+                        for x in tree_leaves(module_inputs)):
+                    nested_paths.add(path)
+                    return outputs
+
+                taps.append((path, module_inputs[0], outputs.shape))
+                return outputs + next(perturbations) if output_perturbations else outputs
+
+            loss = loss_fun(params, *inputs, interceptor=interceptor, **kwargs)
+            return loss, [x for _, x, _ in taps]
+
+        def update(state, *inputs, **kwargs):
+            step, values = state
+            params = self.get_parameters(state)
+
+            shape_taps, nested_paths = [], set()
+            eval_shape(lambda params: tapped_loss(params, None, inputs, kwargs, shape_taps,
+                                                  nested_paths)[0], params)
+            perturbations = [np.zeros(shape) for _, _, shape in shape_taps]
+
+            taps = []
+            (loss, layer_inputs), (gradients, output_gradients) = value_and_grad(
+                lambda p, o: tapped_loss(p, o, inputs, kwargs, taps, set()),
+                argnums=(0, 1), has_aux=True)(params, perturbations)
+
+            paths = tree_leaves(_parameter_paths(params))
+            leaf_gradients, tree = tree_flatten(gradients)
+            leaf_states = tree.flatten_up_to(values)
+            gradient_by_path = dict(zip(paths, leaf_gradients))
+            state_by_path = dict(zip(paths, leaf_states))
+
+            tapped_paths = {path for path, _, _ in taps}
+            layer_paths = [path for path in _dense_layer_paths(params)
+                           if self._is_own(state_by_path[_child_path(path, 'kernel')])]
+            inputs_by_layer = {path: ([], []) for path in layer_paths
+                               if path in tapped_paths and path not in nested_paths}
+            for (path, _, _), x, g in zip(taps, layer_inputs, output_gradients):
+                if path in inputs_by_layer:
+                    layer_inputs_, layer_output_gradients = inputs_by_layer[path]
+                    layer_inputs_.append(x)
+                    layer_output_gradients.append(g)
+
+            # Layers without statistics (applied within control flow or not at all)
+            # are handed over to the fallback:
+            for path in layer_paths:
+                if path not in inputs_by_layer:
+                    for child_path in (_child_path(path, 'kernel'), _child_path(path, 'bias')):
+                        state_by_path[child_path] = self.fallback._init_for_parameter_at(
+                            child_path, getattr(state_by_path[child_path], _PARAMETER))
+
+            new_state_by_path = {}
+            for path, (layer_inputs_, layer_output_gradients) in inputs_by_layer.items():
+                kernel_path, bias_path = _child_path(path, 'kernel'), _child_path(path, 'bias')
+                new_state_by_path[kernel_path], new_state_by_path[bias_path] = \
+                    self._update_layer(step, gradient_by_path[kernel_path],
+                                       gradient_by_path[bias_path], state_by_path[kernel_path],
+                                       state_by_path[bias_path], layer_inputs_,
+                                       layer_output_gradients)
+
+            new_state = State(step + 1, tree.unflatten([
+                new_state_by_path[path] if path in new_state_by_path else
+                self._update_for_parameter_at(step, path, gradient, state_by_path[path])
+                for path, gradient in zip(paths, leaf_gradients)]))
+
+            if return_statistics:
+                return new_state, loss, _statistics(gradients, params,
+                                                    self.get_parameters(new_state))
+
+            return (new_state, loss) if return_loss else new_state
+
+        return update
+
+    def update_from_gradients(self, gradients, state):
+        raise ValueError('KFac requires layer statistics, use `update` instead.')
+
+    def update_truncated(self, loss_fun, state, carry, *sequences, window_length, jit=False,
+                         remat=False):
+        raise NotImplementedError('Truncated backpropagation through time is not supported for '
+                                  '`KFac`, which requires layer statistics, use `update` instead.')
+
+    def update_with_running_statistics(self, loss, state, *inputs, jit=False, **kwargs):
+        raise NotImplementedError('Updating running statistics is not supported for `KFac`, '
+                                  'which intercepts layers itself.')
+
+    def _init_for_parameter(self, parameter):
+        raise ValueError('KFac requires the full parameter tree, use `init` instead.')
+
+    def _update_for_parameter(self, step, gradient, state):
+        return self._update_for_parameter_at(step, '', gradient, state)
+
+    def _get_parameter(self, state):
+        return self._get_parameter_at('', state)
@@ -440,6 +440,104 @@ def test_scan_parametrized_nonflat_cell():
     assert (3, 2) == outs.shape
 
 
+def test_scan_mixed_body():
+    dense = Dense(2)
+
+    @parametrized
+    def rnn(inputs):
+        def body(carry, x):
+            carry = np.tanh(dense(np.concatenate((carry, x))) + carry)
+            return carry, 2 * carry
+
+        _, outs = lax.scan(body, np.zeros((2,)), inputs)
+        return outs
+
+    inputs = random_inputs((3, 4))
+    params = rnn.init_parameters(inputs, key=PRNGKey(0))
+    assert (6, 2) == params.dense.kernel.shape
+
+    carry = np.zeros((2,))
+    expected = []
+    for x in inputs:
+        carry = np.tanh(dense.apply(params.dense, np.concatenate((carry, x))) + carry)
+        expected.append(2 * carry)
+
+    assert np.allclose(np.stack(expected), rnn.apply(params, inputs), atol=1e-6)
+    assert np.allclose(np.stack(expected), rnn.apply(params, inputs, jit=True), atol=1e-6)
+
+
+def test_nested_scan():
+    @parametrized
+    def net(inputs):
+        def outer(carry, xs):
+            _, ys = lax.scan(lambda c, x: (c, Dense(2)(x) + c), carry, xs)
+            return carry + 1, ys
+
+        _, outs = lax.scan(outer, np.zeros((2,)), inputs)
+        return outs
+
+    inputs = random_inputs((3, 4, 5))
+    params = net.init_parameters(inputs, key=PRNGKey(0))
+    assert (5, 2) == params.dense.kernel.shape
+    outs = net.apply(params, inputs, jit=True)
+    assert (3, 4, 2) == outs.shape
+    assert np.allclose(Dense(2).apply(params.dense, inputs) + np.arange(3.)[:, None, None], outs,
+                       atol=1e-6)
+
+
+@pytest.mark.parametrize('jit', (False, True))
+def test_fori_loop(jit):
+    dense = Dense(3)
+
+    @parametrized
+    def net(inputs):
+        return lax.fori_loop(0, 4, lambda i, x: relu(dense(x)) + i, inputs)
+
+    inputs = random_inputs((2, 3))
+    params = net.init_parameters(inputs, key=PRNGKey(0))
+    assert (3, 3) == params.dense.kernel.shape
+
+    expected = inputs
+    for i in range(4):
+        expected = relu(dense.apply(params.dense, expected)) + i
+
+    assert np.allclose(expected, net.apply(params, inputs, jit=jit), atol=1e-6)
+
+
+def test_while_loop():
+    @parametrized
+    def net(inputs):
+        threshold = parameter((), lambda key, shape: 10 * np.ones(shape))
+        _, outputs = lax.while_loop(lambda state: np.sum(state[1]) < threshold,
+                                    lambda state: (state[0], 2 * state[1]), (threshold, inputs))
+        return outputs
+
+    inputs = np.ones((2,))
+    params = net.init_parameters(inputs, key=PRNGKey(0))
+    assert np.array_equal(np.full((2,), 8.), net.apply(params, inputs))
+    params = params._replace(parameter=np.array(100.))
+    assert np.array_equal(np.full((2,), 64.), net.apply(params, inputs, jit=True))
+
+
+@pytest.mark.parametrize('jit', (False, True))
+def test_cond(jit):
+    first, second = Dense(2), Dense(2)
+
+    @parametrized
+    def net(pred, inputs):
+        return lax.cond(pred, inputs, first, inputs, lambda x: relu(second(x)))
+
+    inputs = random_inputs((3, 4))
+    params = net.init_parameters(True, inputs, key=PRNGKey(0))
+    assert (4, 2) == params.dense0.kernel.shape
+    assert (4, 2) == params.dense1.kernel.shape
+
+    assert np.allclose(first.apply(params.dense0, inputs),
+                       net.apply(params, True, inputs, jit=jit), atol=1e-6)
+    assert np.allclose(relu(second.apply(params.dense1, inputs)),
+                       net.apply(params, False, inputs, jit=jit), atol=1e-6)
+
+
 def test_input_dependent_modules():
     @parametrized
     def net(inputs):
@@ -785,3 +883,31 @@ def test_save_and_load_params():
     params_ = load(path)
 
     assert_dense_parameters_equal(params, params_)
+
+
+def test_interceptor():
+    inner = Dense(2)
+    net = Sequential(Dense(3), relu, inner)
+    inputs = np.ones((1, 2))
+    params = net.init_parameters(inputs, key=PRNGKey(0))
+
+    calls = []
+
+    def interceptor(module, parameters, *inputs, path):
+        calls.append((module, path))
+        outputs = module.apply(parameters, *inputs)
+        return 2 * outputs if module is inner else outputs
+
+    out = net.apply(params, inputs, interceptor=interceptor)
+    assert np.allclose(2 * net.apply(params, inputs), out)
+    assert (inner, 'dense1') in calls
+    assert 2 == len([module for module, _ in calls if module.__name__ == 'dense'])
+    assert {'dense0', 'dense0/kernel', 'dense0/bias', 'dense1', 'dense1/kernel', 'dense1/bias'} \
+           == set(path for _, path in calls)
+
+    out_ = jit(lambda params, inputs: net.apply(params, inputs, interceptor=interceptor))(
+        params, inputs)
+    assert np.allclose(out, out_)
+
+    with pytest.raises(ValueError):
+        net.apply(params, inputs, jit=True, interceptor=interceptor)
@@ -1,14 +1,17 @@
 import time
 from collections import namedtuple
 
-from jax import numpy as np, random
+from jax import numpy as np, random, tree_leaves, jit, partial
 from jax.nn import relu, log_softmax, softplus, softmax
 from jax.nn.initializers import normal, glorot_normal, zeros
 from jax.random import PRNGKey
 
 from examples.mnist_vae import gaussian_sample, bernoulli_logpdf, gaussian_kl
-from examples.pixelcnn import PixelCNNPP, image_dtype
-from examples.wavenet import calculate_receptive_field, discretized_mix_logistic_loss, Wavenet
+from examples.pixelcnn import PixelCNNPP, image_dtype, sample, sample_naive, DownShiftedConv, \
+    DownRightShiftedConv, DownShiftedConvTranspose, DownRightShiftedConvTranspose, down_shift, \
+    right_shift, NIN
+from examples.wavenet import calculate_receptive_field, discretized_mix_logistic_loss, Wavenet, \
+    init_queues, generation_step, generate, generate_naive
 from jaxnet import parametrized, Dense, Sequential, Conv, flatten, GRUCell, Rnn, \
     Parameter, parameter, Reparametrized, L2Regularized, optimizers
 from jaxnet.core import ShapedParametrized
@@ -147,6 +150,70 @@ def test_mnist_classifier():
     assert (3, 10) == predictions.shape
 
 
+def test_mnist_classifier_weight_decay():
+    from examples.mnist_classifier import loss
+
+    inputs, targets = random.uniform(PRNGKey(1), (3, 784)), np.eye(10)[:3]
+    params = loss.init_parameters(inputs, targets, key=PRNGKey(0))
+    reg_loss = L2Regularized(loss, scale=.1)
+    reg_params = reg_loss.init_parameters(inputs, targets, key=PRNGKey(0))._replace(model=params)
+
+    def updated(opt, loss, params):
+        return opt.get_parameters(opt.update(loss.apply, opt.init(params), inputs, targets))
+
+    adam = updated(optimizers.Adam(), loss, params).sequential.dense0
+    adamw = updated(optimizers.AdamW(weight_decay=.1), loss, params).sequential.dense0
+    l2 = updated(optimizers.Adam(), reg_loss, reg_params).model.sequential.dense0
+
+    # decoupled decay shrinks kernels in addition to the Adam step, and excludes biases:
+    kernel = params.sequential.dense0.kernel
+    assert np.allclose(adam.kernel - .001 * .1 * kernel, adamw.kernel, atol=1e-7)
+    assert np.array_equal(adam.bias, adamw.bias)
+    # while Adam normalizes the L2 regularization gradient together with the loss gradient:
+    assert not np.allclose(l2.kernel, adamw.kernel, atol=1e-6)
+
+
+def test_mnist_classifier_Adafactor_memory():
+    from examples.mnist_classifier import loss
+
+    def state_size(opt):
+        state = opt.init(loss.init_parameters(np.zeros((3, 784)), np.zeros((3, 10)),
+                                              key=PRNGKey(0)))
+        return sum(x.size for x in tree_leaves(state.values))
+
+    params_size = sum(x.size for x in tree_leaves(
+        loss.init_parameters(np.zeros((3, 784)), np.zeros((3, 10)), key=PRNGKey(0))))
+
+    assert 3 * params_size == state_size(optimizers.Adam())
+    # Only the smallest, 1024x10 kernel and the biases are not factored:
+    assert 1.02 * params_size > state_size(optimizers.Adafactor())
+
+
+def test_mnist_classifier_CompressedState():
+    from examples.mnist_classifier import loss
+
+    inputs = random.uniform(PRNGKey(0), (3, 784))
+    targets = np.eye(10)[np.array([1, 4, 9])]
+    params = loss.init_parameters(inputs, targets, key=PRNGKey(0))
+
+    def train(opt):
+        state = opt.init(params)
+        losses = []
+        for _ in range(5):
+            state, l = opt.update_and_get_loss(loss.apply, state, inputs, targets, jit=True)
+            losses.append(l)
+        return sum(x.nbytes for x in tree_leaves(state.values)), np.array(losses)
+
+    params_bytes = sum(x.nbytes for x in tree_leaves(params))
+    adam_bytes, adam_losses = train(optimizers.Adam())
+    assert 3 * params_bytes == adam_bytes
+
+    for precision, max_bytes in (('bfloat16', 2.01), ('int8', 1.52)):
+        state_bytes, losses = train(optimizers.CompressedState(optimizers.Adam(), precision))
+        assert max_bytes * params_bytes > state_bytes
+        assert np.allclose(adam_losses, losses, rtol=1e-2)
+
+
 def test_mnist_vae():
     @parametrized
     def encode(input):
@@ -242,6 +309,63 @@ def test_wavenet():
     assert () == train_loss.shape
 
 
+def test_wavenet_CompressedState():
+    filter_width = 2
+    initial_filter_width = 3
+    dilations = [1, 2]
+    receptive_field = calculate_receptive_field(filter_width, dilations,
+                                                initial_filter_width)
+
+    batch = random.normal(PRNGKey(0), (1, receptive_field + 1000, 1))
+    output_width = batch.shape[1] - receptive_field + 1
+    wavenet = Wavenet(dilations, filter_width, initial_filter_width,
+                      output_width, 4, 5, 6, 10)
+
+    @parametrized
+    def loss(batch):
+        theta = wavenet(batch)[:, :-1, :]
+        sliced_batch = batch[:, receptive_field:, :]
+        return np.mean(discretized_mix_logistic_loss(theta, sliced_batch, num_class=1 << 16))
+
+    adam = optimizers.Adam()
+    params = loss.init_parameters(batch, key=PRNGKey(0))
+    train_losses = []
+    for opt in (adam, optimizers.CompressedState(adam)):
+        state = opt.init(params)
+        for _ in range(2):
+            state, train_loss = opt.update_and_get_loss(loss.apply, state, batch, jit=True)
+        train_losses.append(train_loss)
+
+    assert np.allclose(*train_losses, rtol=1e-2)
+
+
+def test_wavenet_fast_generation():
+    dilations = [1, 2, 4]
+    filter_width, initial_filter_width = 2, 3
+    receptive_field = calculate_receptive_field(filter_width, dilations, initial_filter_width)
+    length = 12
+    wavenet = Wavenet(dilations, filter_width, initial_filter_width, length,
+                      residual_channels=4, dilation_channels=5, skip_channels=6, nr_mix=2)
+    inputs = random.normal(PRNGKey(0), (2, length, 1))
+    padded = np.concatenate((np.zeros((2, receptive_field - 1, 1)), inputs), axis=1)
+    params = wavenet.init_parameters(padded, key=PRNGKey(0))
+    expected = wavenet.apply(params, padded)
+
+    step = jit(partial(generation_step, params, dilations))
+    queues = init_queues(params, dilations, batch_size=2)
+    for t in range(length):
+        queues, theta = step(queues, inputs[:, t])
+        assert np.allclose(expected[:, t], theta, atol=1e-5)
+
+    samples = generate(params, dilations, 5, PRNGKey(1), batch_size=2)
+    assert (2, 5, 1) == samples.shape
+    naive_wavenet = Wavenet(dilations, filter_width, initial_filter_width, 1,
+                            residual_channels=4, dilation_channels=5, skip_channels=6, nr_mix=2)
+    naive_samples = generate_naive(naive_wavenet, params, receptive_field, 5, PRNGKey(1),
+                                   batch_size=2)
+    assert np.allclose(samples, naive_samples, atol=1e-4)
+
+
 def test_pixelcnn():
     loss, _ = PixelCNNPP(nr_filters=1, nr_resnet=1)
     images = np.zeros((2, 16, 16, 3), image_dtype)
@@ -252,6 +376,45 @@ def test_pixelcnn():
     # assert loss.shape == ()
 
 
+def test_pixelcnn_sample():
+    _, pixel_cnn = PixelCNNPP(nr_filters=1, nr_resnet=1)
+    params = pixel_cnn.init_parameters(np.zeros((1, 8, 8, 3)), key=PRNGKey(0))
+    images = pixel_cnn.sample(params, PRNGKey(1), (2, 8, 8, 3))
+    assert (2, 8, 8, 3) == images.shape
+    assert image_dtype == images.dtype
+
+
+def test_pixelcnn_sample_equals_naive():
+    _, pixel_cnn = PixelCNNPP(nr_filters=1, nr_resnet=1, nr_logistic_mix=2)
+    shape = (1, 8, 8, 3)
+    params = pixel_cnn.init_parameters(np.zeros(shape), key=PRNGKey(0))
+    images = pixel_cnn.sample(params, PRNGKey(1), shape)
+    _, test_mode_pixel_cnn = PixelCNNPP(nr_filters=1, nr_resnet=1, nr_logistic_mix=2,
+                                        test_mode=True)
+    naive_images = sample_naive(test_mode_pixel_cnn.network, params, PRNGKey(1), shape, nr_mix=2)
+    assert np.allclose(np.array(images, 'int32'), np.array(naive_images, 'int32'), atol=1)
+
+
+def test_pixelcnn_sample_cached():
+    @parametrized
+    def network(images):
+        u = down_shift(DownShiftedConv(4, filter_shape=(2, 3))(images))
+        ul = (down_shift(DownShiftedConv(4, filter_shape=(1, 3))(images)) +
+              right_shift(DownRightShiftedConv(4, filter_shape=(2, 1))(images)))
+        u = u + DownShiftedConvTranspose(4, strides=(2, 2))(
+            DownShiftedConv(4, strides=(2, 2))(u))
+        ul = ul + DownRightShiftedConvTranspose(4, strides=(2, 2))(
+            DownRightShiftedConv(4, strides=(2, 2))(ul))
+        ul = DownRightShiftedConv(4)(np.concatenate((u, ul), -1))
+        return NIN(20)(relu(ul))
+
+    shape = (2, 8, 6, 3)
+    params = network.init_parameters(np.zeros(shape), key=PRNGKey(0))
+    images = sample(network, params, PRNGKey(1), shape, nr_mix=2)
+    naive_images = sample_naive(network, params, PRNGKey(1), shape, nr_mix=2)
+    assert np.allclose(np.array(images, 'int32'), np.array(naive_images, 'int32'), atol=1)
+
+
 def test_reparametrized_submodule():
     net = Sequential(Conv(2, (3, 3)), relu, Conv(2, (3, 3)), relu, flatten,
                      Reparametrized(Sequential(Dense(2), relu, Dense(2)), Scaled))
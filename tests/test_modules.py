@@ -1,13 +1,24 @@
+import functools
+import operator
+import re
+
 import pytest
-from jax import numpy as np, jit, vmap
-from jax.nn import relu
-from jax.nn.initializers import zeros, ones
+from jax import numpy as np, jit, grad, vmap, pmap, tree_leaves, tree_map, local_device_count, \
+    xla_computation
+from jax.nn import relu, softmax
+from jax.nn.initializers import zeros, ones, normal
 from jax.random import PRNGKey
 from pytest import raises
 
 from jaxnet import Dense, Sequential, Conv, Conv1D, ConvTranspose, Conv1DTranspose, flatten, \
-    MaxPool, AvgPool, GRUCell, Rnn, SumPool, Dropout, BatchNorm, parametrized, parameter, \
-    Regularized, Reparametrized, L2Regularized, Batched
+    MaxPool, AvgPool, GRUCell, LSTMCell, Rnn, pad_to_bucket, bucket_length, SumPool, Dropout, \
+    BatchNorm, parametrized, parameter, \
+    Regularized, Reparametrized, L2Regularized, Batched, MoE, \
+    MultiHeadAttention, FFTConv1D, fft_crossover, SeparableConv, SeparableConv1D, \
+    GeneralConv, ConvAutotuner, \
+    update_running_statistics, fold_batch_norm, LayerNorm, GroupNorm, \
+    DepthToSpace, PixelShuffle, Upsample, ResizeConv, SubpixelConv
+from jaxnet.modules import _measured_fft_crossover
 from tests.util import random_inputs, assert_parameters_equal, enable_checks
 
 enable_checks()
@@ -43,6 +54,48 @@ def test_Conv_runs(channels, filter_shape, padding, strides, input_shape, dilati
     conv.apply(params, inputs)
 
 
+def test_DepthToSpace():
+    inputs = np.reshape(np.arange(2 * 2 * 3 * 8), (2, 2, 3, 8))
+    out = DepthToSpace(2)(inputs)
+    assert out.shape == (2, 4, 6, 2)
+    assert np.array_equal(inputs[1, 1, 2, 6:8], out[1, 3, 5])
+    assert np.array_equal(inputs[1, 1, 2, 2:4], out[1, 2, 5])
+    assert np.array_equal(inputs, np.reshape(np.transpose(np.reshape(
+        out, (2, 2, 2, 3, 2, 2)), (0, 1, 3, 2, 4, 5)), inputs.shape))
+
+    assert PixelShuffle(2)(random_inputs((2, 5, 4))).shape == (2, 10, 2)
+
+    with raises(ValueError):
+        PixelShuffle(2)(random_inputs((2, 3, 3, 6)))
+
+
+def test_Upsample():
+    inputs = random_inputs((2, 3, 4, 5))
+    nearest = Upsample(2)(inputs)
+    assert nearest.shape == (2, 6, 8, 5)
+    assert np.array_equal(inputs, nearest[:, ::2, ::2])
+    assert np.array_equal(inputs, nearest[:, 1::2, 1::2])
+
+    bilinear = Upsample((2, 3), method='bilinear')(inputs)
+    assert bilinear.shape == (2, 6, 12, 5)
+    assert np.allclose(np.mean(inputs, (1, 2)), np.mean(bilinear, (1, 2)), atol=.1)
+    assert np.allclose(.75 * inputs[:, 0, 0] + .25 * inputs[:, 1, 0], bilinear[:, 1, 1])
+    assert np.allclose(inputs[:, 0, 0], bilinear[:, 0, 0])
+
+    with raises(ValueError):
+        Upsample(2, method='cubic')
+
+
+@pytest.mark.parametrize('Upsampling', [ResizeConv, SubpixelConv])
+def test_upsampling_conv(Upsampling):
+    conv = Upsampling(3, (3, 3))
+    inputs = random_inputs((2, 5, 6, 4))
+    params = conv.init_parameters(inputs, key=PRNGKey(0))
+    convt = ConvTranspose(3, (3, 3), strides=(2, 2), padding='SAME')
+    convt_params = convt.init_parameters(inputs, key=PRNGKey(0))
+    assert conv.apply(params, inputs).shape == convt.apply(convt_params, inputs).shape
+
+
 @pytest.mark.parametrize('channels', [2, 3])
 @pytest.mark.parametrize('filter_shape', [(1,), (2,), (3,)])
 @pytest.mark.parametrize('padding', ["SAME", "VALID"])
@@ -79,6 +132,113 @@ def test_Conv1DTranspose_runs(channels, filter_shape, padding, strides, input_sh
     convt.apply(params, inputs)
 
 
+@pytest.mark.parametrize('groups', [1, 2, 4])
+def test_Conv_groups(groups):
+    conv = Conv(6 * groups, (2, 3), padding='SAME', groups=groups)
+    inputs = random_inputs((2, 5, 6, 4))
+    params = conv.init_parameters(inputs, key=PRNGKey(0))
+    assert (2, 3, 4 // groups, 6 * groups) == params.kernel.shape
+
+    out = conv.apply(params, inputs, jit=True)
+    group_conv = Conv(6, (2, 3), padding='SAME')
+    expected = np.concatenate([group_conv.apply(params._replace(
+        kernel=params.kernel[..., 6 * g:6 * (g + 1)], bias=params.bias[6 * g:6 * (g + 1)]),
+        inputs[..., 4 // groups * g:4 // groups * (g + 1)]) for g in range(groups)], axis=-1)
+    assert np.allclose(expected, out, atol=1e-5)
+
+
+def test_Conv_groups_indivisible():
+    with raises(ValueError):
+        Conv1D(3, (2,), groups=2).init_parameters(np.zeros((1, 5, 4)), key=PRNGKey(0))
+
+
+@pytest.mark.parametrize('conv_fun, kwargs, input_shape', [
+    (Conv, dict(out_chan=3, filter_shape=(2, 3), padding='SAME'), (2, 5, 6, 4)),
+    (GeneralConv, dict(dimension_numbers=('HWCN', 'OIHW', 'NHWC'), out_chan=3,
+                       filter_shape=(3, 3), strides=(2, 2), padding='SAME'), (7, 7, 4, 2)),
+    (Conv1D, dict(out_chan=3, filter_shape=(4,), dilation=(2,)), (2, 20, 4)),
+    (Conv, dict(out_chan=4, filter_shape=(3, 3), groups=2), (2, 5, 5, 4))])
+def test_ConvAutotuner(conv_fun, kwargs, input_shape, tmp_path):
+    inputs = random_inputs(input_shape)
+    conv = conv_fun(**kwargs)
+    params = conv.init_parameters(inputs, key=PRNGKey(0))
+    expected = conv.apply(params, inputs)
+
+    cache_path = tmp_path / 'conv_autotuning.json'
+    autotuner = ConvAutotuner(cache_path, repetitions=1)
+    tuned_conv = conv_fun(**kwargs, autotuner=autotuner)
+    assert 0 == len(autotuner.choices)
+    assert_parameters_equal(params, tuned_conv.init_parameters(inputs, key=PRNGKey(0)))
+    assert 1 == len(autotuner.choices)
+    assert autotuner.choices == ConvAutotuner(cache_path).choices
+    assert np.allclose(expected, tuned_conv.apply(params, inputs, jit=True), atol=1e-4)
+
+
+def test_ConvAutotuner_tunes_when_traced(tmp_path):
+    autotuner = ConvAutotuner(tmp_path / 'conv_autotuning.json', repetitions=1)
+    autotuner._fastest = lambda convolve, layouts, *shapes_and_dtypes: layouts[-1]
+    conv = Conv(3, (2, 2), autotuner=autotuner)
+    inputs = random_inputs((2, 5, 5, 4))
+    params = Conv(3, (2, 2)).init_parameters(inputs, key=PRNGKey(0))
+
+    hlo = xla_computation(conv.apply)(params, inputs).GetHloText()
+    layout, = autotuner.choices.values()
+    assert ['NCHW', 'OIHW', 'NCHW'] == layout
+    assert 'transpose' in hlo
+    assert np.allclose(Conv(3, (2, 2)).apply(params, inputs), jit(conv.apply)(params, inputs),
+                       atol=1e-4)
+
+
+def test_SeparableConv():
+    conv = SeparableConv(8, (3, 3), padding='SAME', depth_multiplier=2)
+    inputs = random_inputs((2, 5, 5, 4))
+    params = conv.init_parameters(inputs, key=PRNGKey(0))
+    assert (3, 3, 1, 8) == params.conv0.kernel.shape
+    assert ('kernel',) == params.conv0._fields
+    assert (1, 1, 8, 8) == params.conv1.kernel.shape
+    assert (8,) == params.conv1.bias.shape
+    assert (2, 5, 5, 8) == conv.apply(params, inputs).shape
+
+    conv1d = SeparableConv1D(3, (5,))
+    inputs = random_inputs((2, 9, 4))
+    params = conv1d.init_parameters(inputs, key=PRNGKey(0))
+    assert (5, 1, 4) == params.conv0.kernel.shape
+    assert (2, 5, 3) == conv1d.apply(params, inputs).shape
+
+
+@pytest.mark.parametrize('padding', ('VALID', 'SAME', [(2, 1)]))
+@pytest.mark.parametrize('filter_shape, dilation', [((1,), None), ((5,), None), ((4,), (3,))])
+def test_FFTConv1D_equals_Conv1D(filter_shape, dilation, padding):
+    inputs = random_inputs((2, 17, 3))
+    conv = Conv1D(4, filter_shape, padding=padding, dilation=dilation)
+    params = conv.init_parameters(inputs, key=PRNGKey(0))
+    expected = conv.apply(params, inputs)
+
+    for crossover in (1, 1000):
+        fft_conv = FFTConv1D(4, filter_shape, padding=padding, dilation=dilation,
+                             crossover=crossover)
+        fft_params = fft_conv.init_parameters(inputs, key=PRNGKey(0))
+        assert_parameters_equal(params, fft_params)
+        assert np.allclose(expected, fft_conv.apply(params, inputs, jit=True), atol=1e-4)
+
+
+def test_FFTConv1D_measures_crossover_once():
+    inputs = random_inputs((2, 19, 3))
+    conv = FFTConv1D(4, (5,))
+    params = conv.init_parameters(inputs, key=PRNGKey(0))
+    misses = _measured_fft_crossover.cache_info().misses
+    conv.apply(params, inputs)
+    FFTConv1D(4, (5,), padding='SAME').apply(params, inputs)
+    assert misses == _measured_fft_crossover.cache_info().misses
+    assert np.allclose(Conv1D(4, (5,)).apply(params, inputs), conv.apply(params, inputs),
+                       atol=1e-4)
+
+
+def test_fft_crossover():
+    crossover = fft_crossover(64, 2, 2, max_width=8, repetitions=1)
+    assert crossover in (1, 2, 4, 8, 9)
+
+
 def test_flatten_shape():
     conv = Conv(2, filter_shape=(3, 3), padding='SAME', kernel_init=zeros, bias_init=zeros)
     inputs = np.zeros((1, 5, 5, 2))
@@ -163,6 +323,102 @@ def test_Rnn_shape():
     assert np.array_equal(np.zeros((2, 5, 3)), out)
 
 
+@pytest.mark.parametrize('length', (1, 7, 64))
+def test_Rnn_hoisted_equals_stepwise(length):
+    gru_cell, carry_init = GRUCell(3, normal())
+    inputs = random_inputs((2, length, 4))
+    rnn = Rnn(gru_cell, carry_init)
+    params = rnn.init_parameters(inputs, key=PRNGKey(0))
+
+    carry = carry_init(2)
+    expected = []
+    for x in np.swapaxes(inputs, 0, 1):
+        carry, y = gru_cell.apply(params.gru_cell, carry, x)
+        expected.append(y)
+
+    out = rnn.apply(params, inputs, jit=True)
+    assert np.allclose(np.stack(expected, axis=1), out, atol=1e-5)
+
+
+def test_LSTMCell_shape():
+    lstm_cell, init_carry = LSTMCell(10, zeros)
+
+    x = np.zeros((2, 3))
+    carry = init_carry(batch_size=2)
+    params = lstm_cell.init_parameters(carry, x, key=PRNGKey(0))
+    assert (13, 40) == params.kernel.shape
+    assert (40,) == params.bias.shape
+
+    (hidden, cell_state), out = lstm_cell.apply(params, carry, x)
+    assert (2, 10) == hidden.shape
+    assert (2, 10) == cell_state.shape
+    assert (2, 10) == out.shape
+
+
+@pytest.mark.parametrize('Cell', (GRUCell, LSTMCell))
+def test_Rnn_step_equals_sequence(Cell):
+    cell, carry_init = Cell(3, normal())
+    inputs = random_inputs((2, 7, 4))
+    rnn = Rnn(cell, carry_init, return_carry=True)
+    params = rnn.init_parameters(inputs, key=PRNGKey(0))
+    out, final_carry = rnn.apply(params, inputs)
+
+    step = jit(rnn.step)
+    carry = rnn.carry_init(2)
+    outs = []
+    for x in np.swapaxes(inputs, 0, 1):
+        carry, y = step(params, carry, x)
+        outs.append(y)
+
+    assert np.allclose(out, np.stack(outs, axis=1), atol=1e-5)
+    for expected, actual in zip(tree_leaves(final_carry), tree_leaves(carry)):
+        assert np.allclose(expected, actual, atol=1e-5)
+
+    first, carry = rnn.apply(params, inputs[:, :3])
+    second, carry = rnn.apply(params, inputs[:, 3:], carry)
+    assert np.allclose(out, np.concatenate((first, second), axis=1), atol=1e-5)
+
+
+@pytest.mark.parametrize('Cell', (GRUCell, LSTMCell))
+def test_Rnn_lengths(Cell):
+    cell, carry_init = Cell(3, normal())
+    inputs = random_inputs((2, 6, 4))
+    lengths = np.array([6, 3])
+    rnn = Rnn(cell, carry_init, return_carry=True)
+    params = rnn.init_parameters(inputs, key=PRNGKey(0))
+
+    out, carry = rnn.apply(params, inputs, None, lengths, jit=True)
+
+    for i, length in enumerate(lengths):
+        expected_out, expected_carry = rnn.apply(params, inputs[i:i + 1, :length])
+        assert np.allclose(expected_out[0], out[i, :length], atol=1e-5)
+        assert np.array_equal(np.zeros((6 - length, 3)), out[i, length:])
+        for expected, actual in zip(tree_leaves(expected_carry), tree_leaves(carry)):
+            assert np.allclose(expected[0], actual[i], atol=1e-5)
+
+
+def test_pad_to_bucket():
+    buckets = (4, 8, 16)
+    assert 4 == bucket_length(1, buckets)
+    assert 8 == bucket_length(8, buckets)
+    with raises(ValueError):
+        bucket_length(17, buckets)
+
+    traces = []
+
+    @jit
+    def f(xs):
+        traces.append(xs.shape)
+        return xs
+
+    for length in range(1, 17):
+        xs = pad_to_bucket(np.ones((2, length, 3)), buckets)
+        assert np.array_equal(np.ones((2, length, 3)), f(xs)[:, :length])
+        assert not np.any(xs[:, length:])
+
+    assert 3 == len(traces)
+
+
 @pytest.mark.parametrize('center', (False, True))
 @pytest.mark.parametrize('scale', (False, True))
 def test_BatchNorm_shape_NHWC(center, scale):
@@ -197,6 +453,114 @@ def test_BatchNorm_shape_NCHW(center, scale):
         assert params.gamma.shape == (5,)
 
 
+def test_BatchNorm_running_statistics():
+    net = Sequential(Dense(3), BatchNorm(axis=0, momentum=.9), relu)
+    test_net = Sequential(Dense(3), BatchNorm(axis=0, momentum=.9, test_mode=True), relu)
+    inputs = random_inputs((8, 2))
+    params = net.init_parameters(inputs, key=PRNGKey(0))
+    assert params.batch_norm.running_mean.shape == (3,)
+    assert params.batch_norm.running_var.shape == (3,)
+
+    out, updated = update_running_statistics(net, params, inputs)
+    assert np.allclose(net.apply(params, inputs), out)
+    hidden = Dense(3).apply(params.dense, inputs)
+    assert np.allclose(.1 * np.mean(hidden, 0), updated.batch_norm.running_mean, atol=1e-6)
+    assert np.allclose(.9 + .1 * np.var(hidden, 0), updated.batch_norm.running_var, atol=1e-5)
+    assert_parameters_equal(params.dense, updated.dense)
+
+    out = test_net.apply(updated, inputs)
+    assert np.allclose(out[:1], test_net.apply(updated, inputs[:1]))
+    assert not np.allclose(out[:1], net.apply(updated, inputs[:1]))
+
+    with raises(ValueError):
+        BatchNorm(test_mode=True)
+
+
+def test_BatchNorm_running_statistics_not_trained():
+    net = Sequential(Dense(3), BatchNorm(axis=0, momentum=.9, test_mode=True), relu, np.sum)
+    regularized = L2Regularized(net, .1)
+    inputs = random_inputs((8, 2))
+    params = regularized.init_parameters(inputs, key=PRNGKey(0))
+    gradients = grad(regularized.apply)(params, inputs)
+    assert np.all(0 == gradients.model.batch_norm.running_mean)
+    assert np.all(0 == gradients.model.batch_norm.running_var)
+    assert not np.all(0 == gradients.model.batch_norm.gamma)
+
+
+def test_LayerNorm():
+    layer_norm = LayerNorm()
+    inputs = 1000 + random_inputs((3, 4, 5))
+    params = layer_norm.init_parameters(inputs, key=PRNGKey(0))
+    assert params.gamma.shape == (5,)
+    assert params.beta.shape == (5,)
+
+    out = layer_norm.apply(params, inputs)
+    mean = np.mean(inputs, -1, keepdims=True)
+    expected = (inputs - mean) / np.sqrt(np.mean((inputs - mean) ** 2, -1, keepdims=True) + 1e-5)
+    assert np.allclose(expected, out, atol=1e-3)
+
+    out_half = layer_norm.apply(params, inputs.astype(np.float16))
+    assert out_half.dtype == np.float16
+    assert np.allclose(out, out_half, atol=1e-1)
+
+
+def test_GroupNorm():
+    group_norm = GroupNorm(num_groups=2)
+    inputs = random_inputs((3, 4, 5, 6))
+    params = group_norm.init_parameters(inputs, key=PRNGKey(0))
+    assert params.gamma.shape == (6,)
+    assert params.beta.shape == (6,)
+
+    out = group_norm.apply(params, inputs)
+    grouped = np.reshape(inputs, (3, 4, 5, 2, 3))
+    mean = np.mean(grouped, (1, 2, 4), keepdims=True)
+    var = np.var(grouped, (1, 2, 4), keepdims=True)
+    expected = np.reshape((grouped - mean) / np.sqrt(var + 1e-5), inputs.shape)
+    assert np.allclose(expected, out, atol=1e-5)
+
+    with raises(ValueError):
+        GroupNorm(num_groups=4).init_parameters(inputs, key=PRNGKey(0))
+
+
+@pytest.mark.skipif(local_device_count() < 2, reason='Requires multiple devices, for example '
+                    'with XLA_FLAGS=--xla_force_host_platform_device_count=4 on CPU.')
+def test_BatchNorm_axis_name():
+    devices = local_device_count()
+    batch_norm = BatchNorm(axis=0, momentum=.9, axis_name='batch')
+    inputs = random_inputs((devices, 3, 4))
+    params = pmap(lambda inputs: batch_norm.init_parameters(inputs, key=PRNGKey(0)),
+                  axis_name='batch')(inputs)
+    out = pmap(lambda params, inputs: batch_norm.apply(params, inputs),
+               axis_name='batch')(params, inputs)
+
+    all_inputs = np.reshape(inputs, (devices * 3, 4))
+    unsynchronized = BatchNorm(axis=0)
+    expected = unsynchronized.apply(unsynchronized.init_parameters(all_inputs, key=PRNGKey(0)),
+                                    all_inputs)
+    assert np.allclose(expected, np.reshape(out, (devices * 3, 4)), atol=1e-5)
+
+    updated = pmap(lambda params, inputs: update_running_statistics(batch_norm, params, inputs)[1],
+                   axis_name='batch')(params, inputs)
+    for device in range(devices):
+        assert np.allclose(.1 * np.mean(all_inputs, 0), updated.running_mean[device], atol=1e-6)
+
+
+@pytest.mark.parametrize('layer, input_shape', [(Dense(3), (2, 5)),
+                                                (Conv(3, (2, 2)), (2, 5, 5, 2))])
+def test_fold_batch_norm(layer, input_shape):
+    bn_axis = tuple(range(len(input_shape) - 1))
+    batch_norm = BatchNorm(axis=bn_axis, epsilon=.1, momentum=.9, test_mode=True)
+    net = Sequential(layer, batch_norm)
+    inputs = random_inputs(input_shape)
+    params = net.init_parameters(inputs, key=PRNGKey(0))
+    _, params = update_running_statistics(net, params, inputs)
+    params = params._replace(batch_norm=params.batch_norm._replace(
+        gamma=2 * params.batch_norm.gamma + 1, beta=params.batch_norm.beta - .5))
+
+    folded = fold_batch_norm(batch_norm, params[0], params.batch_norm)
+    assert np.allclose(net.apply(params, inputs), layer.apply(folded, inputs), atol=1e-5)
+
+
 def test_Sequential_graceful_update_message():
     message = 'Call like Sequential(Dense(10), relu), without "[" and "]". ' \
               '(Or pass iterables with Sequential(*layers).)'
@@ -329,3 +693,113 @@ def test_Batched():
     assert_parameters_equal((unbatched_params,), params)
     out_batched = dense.apply(params, np.ones((batch_size, 2)))
     assert np.array_equal(out_batched_, out_batched)
+
+
+@pytest.mark.parametrize('k', (1, 2))
+def test_MoE(k):
+    moe = MoE(lambda: Sequential(Dense(5), relu, Dense(3)), num_experts=4, k=k,
+              capacity_factor=4., return_metrics=True)
+    inputs = random_inputs((2, 6, 3))
+    params = moe.init_parameters(inputs, key=PRNGKey(0))
+    assert (3, 4) == params.dense.kernel.shape
+    assert (4, 3, 5) == params.experts.dense0.kernel.shape
+    assert (4, 5, 3) == params.experts.dense1.kernel.shape
+
+    outputs, metrics = moe.apply(params, inputs, jit=True)
+    assert inputs.shape == outputs.shape
+    assert 0 == metrics.dropped_fraction
+    assert metrics.load_balancing_loss >= 1 - 1e-6
+
+    x = np.reshape(inputs, (-1, 3))
+    probs = softmax(Dense(4).apply(params.dense, x))
+    experts = Sequential(Dense(5), relu, Dense(3))
+    expert_outputs = np.stack([experts.apply(tree_map(lambda p: p[e], params.experts), x)
+                               for e in range(4)], axis=1)
+    ranks = np.argsort(-probs, axis=-1)[:, :k]
+    gates = np.take_along_axis(probs, ranks, axis=-1)
+    gates = gates / np.sum(gates, axis=-1, keepdims=True) if k > 1 else gates
+    expected = np.sum(gates[..., None] * np.take_along_axis(expert_outputs, ranks[..., None], 1),
+                      axis=1)
+    assert np.allclose(expected, np.reshape(outputs, (-1, 3)), atol=1e-5)
+
+
+def test_MoE_drops_tokens_beyond_capacity():
+    moe = MoE(lambda: Dense(3), num_experts=2, capacity_factor=.25, return_metrics=True)
+    inputs = random_inputs((8, 3))
+    params = moe.init_parameters(inputs, key=PRNGKey(0))
+    outputs, metrics = moe.apply(params, inputs)
+    assert metrics.dropped_fraction >= .5
+    assert 8 - 2 <= np.sum(np.all(outputs == 0, axis=-1))
+
+
+def _largest_array_size(fun, *args):
+    hlo = xla_computation(fun)(*args).GetHloText()
+    sizes = [functools.reduce(operator.mul, map(int, filter(None, dims.split(','))), 1)
+             for dims in re.findall(r'\[([\d,]*)\]', hlo)]
+    return max(sizes)
+
+
+def test_MoE_dispatch_linear_in_tokens():
+    moe = MoE(lambda: Dense(3), num_experts=4, k=2)
+
+    def largest_array_size(tokens):
+        inputs = random_inputs((tokens, 3))
+        params = moe.init_parameters(inputs, key=PRNGKey(0))
+        return _largest_array_size(moe.apply, params, inputs)
+
+    assert largest_array_size(256) <= 2.5 * largest_array_size(128)
+
+
+def _reference_attention(params, queries, memory, num_heads, causal):
+    def heads(x, kernel):
+        return np.reshape(np.dot(x, kernel), x.shape[:-1] + (num_heads, -1))
+
+    q, k, v = (heads(queries, params.query_kernel), heads(memory, params.key_kernel),
+               heads(memory, params.value_kernel))
+    scores = np.einsum('bqhd,bkhd->bhqk', q, k) / np.sqrt(q.shape[-1])
+    if causal:
+        scores = np.where(np.tril(np.ones(scores.shape[-2:], bool)), scores, -np.inf)
+    attended = np.einsum('bhqk,bkhd->bqhd', softmax(scores), v)
+    attended = np.reshape(attended, attended.shape[:2] + (-1,))
+    return np.dot(attended, params.output_kernel) + params.output_bias
+
+
+@pytest.mark.parametrize('chunk_size', (None, 1, 3, 16))
+@pytest.mark.parametrize('causal', (False, True))
+def test_MultiHeadAttention(chunk_size, causal):
+    attention = MultiHeadAttention(2, 4, causal=causal, chunk_size=chunk_size)
+    inputs = random_inputs((2, 7, 5))
+    params = attention.init_parameters(inputs, key=PRNGKey(0))
+    assert (5, 8) == params.query_kernel.shape
+    assert (8, 5) == params.output_kernel.shape
+
+    out = attention.apply(params, inputs, jit=True)
+    assert inputs.shape == out.shape
+    assert np.allclose(_reference_attention(params, inputs, inputs, 2, causal), out, atol=1e-5)
+
+
+def test_MultiHeadAttention_memory():
+    attention = MultiHeadAttention(2, 4, chunk_size=2)
+    inputs, memory = random_inputs((2, 3, 5)), random_inputs((2, 5, 6))
+    params = attention.init_parameters(inputs, memory, key=PRNGKey(0))
+    assert (6, 8) == params.key_kernel.shape
+    out = attention.apply(params, inputs, memory)
+    assert np.allclose(_reference_attention(params, inputs, memory, 2, False), out, atol=1e-5)
+
+
+def test_MultiHeadAttention_decode():
+    attention = MultiHeadAttention(2, 4, causal=True)
+    inputs = random_inputs((2, 6, 5))
+    params = attention.init_parameters(inputs, key=PRNGKey(0))
+    expected = attention.apply(params, inputs)
+
+    decode = jit(attention.decode)
+    cache = attention.init_cache(2, 10)
+    cache, first = decode(params, cache, inputs[:, :2])
+    outputs = [first]
+    for t in range(2, 6):
+        cache, out = decode(params, cache, inputs[:, t:t + 1])
+        outputs.append(out)
+
+    assert 6 == cache.length
+    assert np.allclose(expected, np.concatenate(outputs, axis=1), atol=1e-5)
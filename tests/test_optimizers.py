@@ -1,12 +1,14 @@
 from pathlib import Path
 
 import pytest
+from jax import lax, tree_map, tree_leaves, tree_multimap
 from jax.nn import relu, log_softmax
 from jax.random import PRNGKey
 
 from jaxnet import *
+from jaxnet import optimizers
 from jaxnet.optimizers import *
-from tests.util import enable_checks
+from tests.util import enable_checks, random_inputs, assert_parameters_equal
 
 enable_checks()
 
@@ -22,7 +24,18 @@ def loss_without_parameters(inputs, targets):
 
 
 @pytest.mark.parametrize('jit', (False, True))
-@pytest.mark.parametrize('opt', (Sgd(), Momentum(.1, .1), Adagrad(), RmsProp(.1), Adam(), Sm3(.1)))
+@pytest.mark.parametrize('opt', (Sgd(), Momentum(.1, .1), Adagrad(), RmsProp(.1), Adam(), Sm3(.1),
+                                 Adafactor(), Adafactor(min_dim_size_to_factor=1),
+                                 Adafactor(.01, momentum=.9, clipping_threshold=None,
+                                           relative_step=False, min_dim_size_to_factor=1),
+                                 Lars(.1), Lamb(), Lamb(weight_decay=.01, exclude=None),
+                                 CompressedState(Adam()), CompressedState(Adam(), 'bfloat16'),
+                                 CompressedState(Sm3(.1), block_size=3),
+                                 Grouped(Adam(), {'sequential/dense0': None,
+                                                  'sequential/dense1/bias': Sgd()}),
+                                 WeightDecayed(Momentum(.1, .1), .01), AdamW(),
+                                 Clipped(Adam(), max_global_norm=1., max_norm=.1),
+                                 Averaged(Adam()), Averaged(Sm3(.1), .9, dtype=np.bfloat16)))
 @pytest.mark.parametrize('loss', (loss_with_parameters, loss_without_parameters))
 def test(loss, jit, opt):
     def next_batch():
@@ -60,3 +73,508 @@ def test(loss, jit, opt):
     state = load(path)
 
     check()
+
+
+@pytest.mark.parametrize('jit', (False, True))
+@pytest.mark.parametrize('opt', (Sweep(Sgd, step_size=[.1, .01]),
+                                 Sweep(Momentum, step_size=[.1, .01], mass=[.9, .5]),
+                                 Sweep(Adam, step_size=[1e-3, 1e-4])))
+def test_Sweep(jit, opt):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    state = opt.init(params)
+    assert (2, 4, 4) == opt.get_parameters(state).sequential.dense1.kernel.shape
+
+    state, losses = opt.update_and_get_loss(loss_with_parameters.apply, state, inputs, targets,
+                                            jit=jit)
+    assert (2,) == losses.shape
+    assert np.allclose(losses[0], losses[1])
+
+    state = opt.update(loss_with_parameters.apply, state, inputs, targets, jit=jit)
+    kernels = opt.get_parameters(state).sequential.dense1.kernel
+    assert not np.allclose(kernels[0], kernels[1])
+
+    configs = opt.unstack(state, losses)
+    assert 2 == len(configs)
+    for config_opt, config_state, loss in configs:
+        assert () == loss.shape
+        assert 2 == config_opt.get_step(config_state)
+        assert (4, 4) == config_opt.get_parameters(config_state).sequential.dense1.kernel.shape
+        config_opt.update(loss_with_parameters.apply, config_state, inputs, targets, jit=jit)
+
+
+def test_Sweep_unequal_lengths():
+    with pytest.raises(ValueError):
+        Sweep(Momentum, step_size=[.1, .01], mass=[.9])
+
+
+def test_Adafactor_factored_state():
+    params = loss_with_parameters.init_parameters(np.zeros((3, 10)), np.zeros((3, 4)),
+                                                  key=PRNGKey(0))
+    opt = Adafactor(min_dim_size_to_factor=4)
+    state = opt.init(params)
+    dense0, dense1 = state.values.sequential.dense0, state.values.sequential.dense1
+    assert ('parameter', 'v_row', 'v_col') == dense0.kernel._fields
+    assert (10,) == dense0.kernel.v_row.shape
+    assert (4,) == dense0.kernel.v_col.shape
+    assert ('parameter', 'v') == dense1.bias._fields
+    assert (4,) == dense1.bias.v.shape
+
+
+def test_parameter_paths():
+    params = loss_with_parameters.init_parameters(np.zeros((3, 10)), np.zeros((3, 4)),
+                                                  key=PRNGKey(0))
+    paths = optimizers._parameter_paths(params)
+    assert 'sequential/dense0/kernel' == paths.sequential.dense0.kernel
+    assert 'sequential/dense1/bias' == paths.sequential.dense1.bias
+    assert '' == optimizers._parameter_paths(np.zeros(()))
+
+
+@pytest.mark.parametrize('opt', (Lars(.1), Lamb(.1)))
+def test_layerwise_adaptive_excludes_biases(opt):
+    params = loss_with_parameters.init_parameters(np.ones((3, 10)), np.ones((3, 4)),
+                                                  key=PRNGKey(0))
+    gradients = tree_map(lambda x: 1e3 * np.ones_like(x), params)
+    state = opt.update_from_gradients(gradients, opt.init(params))
+    new_params = opt.get_parameters(state)
+
+    def relative_change(old, new):
+        return np.linalg.norm(new - old) / np.linalg.norm(old)
+
+    dense = params.sequential.dense0
+    new_dense = new_params.sequential.dense0
+    # the kernel update is bounded by its trust ratio, the bias update is not:
+    assert relative_change(dense.kernel, new_dense.kernel) < 1
+    assert relative_change(dense.bias, new_dense.bias) > 1
+
+
+@pytest.mark.parametrize('shape', ((), (5,), (3, 100)))
+def test_quantize(shape):
+    x = random_inputs(shape) - .5 if shape else np.array(.3)
+    q, scales = optimizers._quantize(x, block_size=64)
+    assert np.int8 == q.dtype
+    assert shape == q.shape
+    assert (-(-x.size // 64),) == scales.shape
+    x_ = optimizers._dequantize(q, scales, block_size=64)
+    assert np.allclose(x, x_, atol=.02)
+
+
+def test_CompressedState():
+    params = loss_with_parameters.init_parameters(np.zeros((3, 10)), np.zeros((3, 4)),
+                                                  key=PRNGKey(0))
+    state = CompressedState(Adam(), block_size=8).init(params)
+    kernel_state = state.values.sequential.dense0.kernel
+    assert ('parameter', 'm', 'm_scale', 'v', 'v_scale') == kernel_state._fields
+    assert np.float32 == kernel_state.parameter.dtype
+    assert np.int8 == kernel_state.m.dtype
+    assert (5,) == kernel_state.m_scale.shape
+
+    with pytest.raises(ValueError):
+        CompressedState(Adam(), precision='int4')
+
+
+def test_CompressedState_heterogeneous_magnitudes():
+    # magnitudes within a block differing by 1000x, as for many embeddings or output layers:
+    magnitudes = np.where(np.arange(256) % 2, 1., 1e-3)
+    adam, compressed = Adam(), CompressedState(Adam())
+    state = adam.init(np.zeros(256))
+    compressed_state = compressed.init(np.zeros(256))
+    for key in range(3):
+        gradients = magnitudes * (1 + random_inputs((256,), key=PRNGKey(key)))
+        previous = adam.get_parameters(state)
+        compressed_previous = compressed.get_parameters(compressed_state)
+        state = adam.update_from_gradients(gradients, state)
+        compressed_state = compressed.update_from_gradients(gradients, compressed_state)
+        update = adam.get_parameters(state) - previous
+        compressed_update = compressed.get_parameters(compressed_state) - compressed_previous
+        assert np.allclose(update, compressed_update, rtol=.1, atol=0)
+
+
+@pytest.mark.parametrize('jit', (False, True))
+def test_Grouped(jit):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt = Grouped(Adam(), {'sequential/dense0': None, 'sequential/dense1/bias': Sgd()})
+    state = opt.init(params)
+    dense0, dense1 = state.values.sequential.dense0, state.values.sequential.dense1
+    assert ('parameter',) == dense0.kernel._fields
+    assert ('parameter',) == dense0.bias._fields
+    assert ('parameter', 'm', 'v') == dense1.kernel._fields
+    assert ('parameter',) == dense1.bias._fields
+
+    state, loss = opt.update_and_get_loss(loss_with_parameters.apply, state, inputs, targets,
+                                          jit=jit)
+    assert () == loss.shape
+    assert np.array_equal(params.sequential.dense0.kernel,
+                          opt.get_parameters(state).sequential.dense0.kernel)
+    assert not np.array_equal(params.sequential.dense1.kernel,
+                              opt.get_parameters(state).sequential.dense1.kernel)
+
+    gradients = tree_map(np.ones_like, params)
+    state = opt.update_from_gradients(gradients, state)
+    assert np.array_equal(params.sequential.dense0.bias,
+                          opt.get_parameters(state).sequential.dense0.bias)
+
+
+def test_WeightDecayed_Grouped_keeps_frozen():
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt = WeightDecayed(Grouped(Adam(), {'sequential/dense0': None}), .1)
+    state = opt.init(params)
+    state = opt.update(loss_with_parameters.apply, state, inputs, targets)
+    assert np.array_equal(params.sequential.dense0.kernel,
+                          opt.get_parameters(state).sequential.dense0.kernel)
+    assert not np.array_equal(params.sequential.dense1.kernel,
+                              opt.get_parameters(state).sequential.dense1.kernel)
+
+
+@pytest.mark.parametrize('jit', (False, True))
+def test_WeightDecayed_equals_L2Regularized_for_Sgd(jit):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    reg_loss = L2Regularized(loss_with_parameters, scale=.2)
+    reg_params = reg_loss.init_parameters(inputs, targets, key=PRNGKey(0))
+
+    reg_opt = Sgd(.1)
+    reg_state = reg_opt.update(reg_loss.apply, reg_opt.init(reg_params), inputs, targets, jit=jit)
+
+    opt = WeightDecayed(Sgd(.1), .1 * .2, exclude=None)
+    state = opt.update(loss_with_parameters.apply, opt.init(reg_params.model), inputs, targets,
+                       jit=jit)
+
+    for p, p_ in zip(tree_leaves(reg_opt.get_parameters(reg_state).model),
+                     tree_leaves(opt.get_parameters(state))):
+        assert np.allclose(p, p_)
+
+
+def test_WeightDecayed_excludes_biases():
+    params = loss_with_parameters.init_parameters(np.ones((3, 10)), np.ones((3, 4)),
+                                                  key=PRNGKey(0))
+    opt = WeightDecayed(Sgd(), .5)
+    state = opt.update_from_gradients(tree_map(np.zeros_like, params), opt.init(params))
+    new_params = opt.get_parameters(state)
+    assert np.allclose(.5 * params.sequential.dense0.kernel, new_params.sequential.dense0.kernel)
+    assert np.array_equal(params.sequential.dense0.bias, new_params.sequential.dense0.bias)
+
+
+def test_weight_decay_excludes_BatchNorm_statistics_only():
+    exclude = optimizers._is_bias_or_normalization
+    assert exclude('sequential/batch_norm/running_mean')
+    assert exclude('model/batch_norm1/running_var')
+    assert not exclude('sequential/gaussian/mean')
+    assert not exclude('var')
+
+
+@pytest.mark.parametrize('opt', (Sgd(), Adam(), Sm3(.1), CompressedState(Adam()), AdamW(),
+                                 Clipped(Adam(), max_global_norm=1.), Averaged(Adam()),
+                                 Grouped(Adam(), {'sequential/dense0': None}),
+                                 Sweep(Adam, step_size=[.1, .2]), KFac()))
+def test_set_parameters(opt):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    state = opt.update(loss_with_parameters.apply, opt.init(params), inputs, targets)
+    parameters = opt.get_parameters(state)
+    shifted = tree_map(lambda p: p + 1, parameters)
+
+    new_state = opt.set_parameters(state, shifted)
+    assert opt.get_step(state) == opt.get_step(new_state)
+    assert_parameters_equal(shifted, opt.get_parameters(new_state))
+    assert_parameters_equal(state.values, opt.set_parameters(new_state, parameters).values)
+    opt.update(loss_with_parameters.apply, new_state, inputs, targets)
+
+
+@pytest.mark.parametrize('jit', (False, True))
+def test_update_with_running_statistics(jit):
+    @parametrized
+    def loss(inputs):
+        return np.mean(Sequential(Dense(3), BatchNorm(axis=0, momentum=.9), relu)(inputs) ** 2)
+
+    inputs = random_inputs((8, 2))
+    params = loss.init_parameters(inputs, key=PRNGKey(0))
+    opt = AdamW()
+    state, loss_value = opt.update_with_running_statistics(loss, opt.init(params), inputs,
+                                                           jit=jit)
+    new_params = opt.get_parameters(state)
+
+    expected_loss, expected = update_running_statistics(loss, params, inputs)
+    assert np.allclose(expected_loss, loss_value)
+    for name in ('running_mean', 'running_var'):
+        assert np.allclose(getattr(expected.sequential.batch_norm, name),
+                           getattr(new_params.sequential.batch_norm, name))
+        assert not np.allclose(getattr(params.sequential.batch_norm, name),
+                               getattr(new_params.sequential.batch_norm, name))
+
+    expected = opt.get_parameters(opt.update(loss.apply, opt.init(params), inputs))
+    for p, p_ in zip(tree_leaves(expected.sequential.dense),
+                     tree_leaves(new_params.sequential.dense)):
+        assert np.allclose(p, p_)
+
+    for opt in (Sweep(Sgd, step_size=[.1, .2]), KFac()):
+        with pytest.raises(NotImplementedError):
+            opt.update_with_running_statistics(loss, opt.init(params), inputs)
+
+
+@pytest.mark.parametrize('opt', (Adam(), Lamb(), Averaged(Adam()), CompressedState(Adam()),
+                                 Grouped(Sgd(), {'sequential/dense': Adam()})))
+def test_running_statistics_frozen(opt):
+    @parametrized
+    def loss(inputs):
+        return np.mean(Sequential(Dense(3), BatchNorm(axis=0, momentum=.9), relu)(inputs) ** 2)
+
+    inputs = random_inputs((8, 2))
+    params = loss.init_parameters(inputs, key=PRNGKey(0))
+    state = opt.init(params)
+    assert ('parameter',) == state.values.sequential.batch_norm.running_mean._fields
+    assert ('parameter',) == state.values.sequential.batch_norm.running_var._fields
+
+    state, _ = opt.update_with_running_statistics(loss, state, inputs)
+    _, expected = update_running_statistics(loss, params, inputs)
+    parameters = opt.get_parameters(state)
+    assert np.allclose(expected.sequential.batch_norm.running_mean,
+                       parameters.sequential.batch_norm.running_mean)
+    if isinstance(opt, Averaged):
+        averages = opt.get_parameters(state, averaged=True)
+        assert np.allclose(expected.sequential.batch_norm.running_var,
+                           averages.sequential.batch_norm.running_var)
+
+
+@pytest.mark.parametrize('jit', (False, True))
+@pytest.mark.parametrize('opt', (Sgd(), Adam(), Clipped(Adam(), max_global_norm=1., max_norm=.1),
+                                 Grouped(Adam(), {'sequential/dense0': None}),
+                                 Averaged(Adam()), CompressedState(Adam())))
+def test_update_and_get_statistics(jit, opt):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    state, loss, statistics = opt.update_and_get_statistics(
+        loss_with_parameters.apply, opt.init(params), inputs, targets, jit=jit)
+    assert 1 == opt.get_step(state)
+    assert () == loss.shape
+    assert () == statistics.gradient_norm.shape
+    assert () == statistics.update_norm.shape
+    assert statistics.update_norm > 0
+
+
+@pytest.mark.parametrize('jit', (False, True))
+def test_Clipped(jit):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+
+    def scaled_loss(params, inputs, targets):
+        return 1e3 * loss_with_parameters.apply(params, inputs, targets)
+
+    for opt, max_update_norm in ((Clipped(Sgd(1.), max_global_norm=.1), .1 + 1e-6),
+                                 (Clipped(Sgd(1.), max_norm=.1), .4 + 1e-6)):
+        state, _, statistics = opt.update_and_get_statistics(scaled_loss, opt.init(params),
+                                                             inputs, targets, jit=jit)
+        assert statistics.gradient_norm > 1
+        assert statistics.update_norm < max_update_norm
+
+
+@pytest.mark.parametrize('opt', (Averaged(Clipped(Sgd(1.), max_global_norm=.1)),
+                                 WeightDecayed(Clipped(Sgd(1.), max_global_norm=.1), 0.),
+                                 CompressedState(Clipped(Sgd(1.), max_global_norm=.1)),
+                                 Clipped(Grouped(Sgd(1.), {'sequential/dense0': None}),
+                                         max_global_norm=.1),
+                                 Sweep(lambda step_size: Clipped(Sgd(step_size),
+                                                                 max_global_norm=.1),
+                                       step_size=[1., .5])))
+def test_Clipped_global_norm_nested(opt):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+
+    def scaled_loss(params, inputs, targets):
+        return 1e3 * loss_with_parameters.apply(params, inputs, targets)
+
+    state, _, statistics = opt.update_and_get_statistics(scaled_loss, opt.init(params),
+                                                         inputs, targets)
+    assert np.all(statistics.gradient_norm > 1)
+    assert np.all(statistics.update_norm < .1 + 1e-6)
+
+
+def test_Clipped_global_norm_rejected_within_Grouped():
+    with pytest.raises(ValueError):
+        Grouped(Clipped(Adam(), max_global_norm=1.), {'sequential/dense0': None})
+
+    with pytest.raises(ValueError):
+        Grouped(Adam(), {'sequential/dense0': Clipped(Sgd(), max_global_norm=1.)})
+
+    with pytest.raises(ValueError):
+        KFac(fallback=Clipped(Adam(), max_global_norm=1.))
+
+    Grouped(Clipped(Adam(), max_norm=1.), {'sequential/dense0': None})
+
+
+def test_Sweep_frozen():
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt = Sweep(lambda step_size: Grouped(Sgd(step_size), {'sequential/dense0': None}),
+                step_size=[.1, .2])
+    state = opt.update(loss_with_parameters.apply, opt.init(params), inputs, targets)
+    new_params = opt.get_parameters(state)
+    for i in range(2):
+        assert_parameters_equal(params.sequential.dense0,
+                                tree_map(lambda x: x[i], new_params.sequential.dense0))
+        assert not np.allclose(params.sequential.dense1.kernel,
+                               new_params.sequential.dense1.kernel[i])
+
+
+def test_statistics_Sweep_and_Grouped():
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+
+    opt = Sweep(Sgd, step_size=[.1, 0.])
+    _, losses, statistics = opt.update_and_get_statistics(loss_with_parameters.apply,
+                                                          opt.init(params), inputs, targets)
+    assert (2,) == losses.shape
+    assert (2,) == statistics.gradient_norm.shape
+    assert statistics.update_norm[0] > 0
+    assert 0 == statistics.update_norm[1]
+
+    opt = Grouped(Sgd(), {'sequential': None})
+    _, _, statistics = opt.update_and_get_statistics(loss_with_parameters.apply,
+                                                     opt.init(params), inputs, targets)
+    assert 0 == statistics.gradient_norm
+    assert 0 == statistics.update_norm
+
+
+@pytest.mark.parametrize('jit', (False, True))
+def test_Averaged(jit):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt = Averaged(Sgd(.1), decay=.5)
+    state = opt.init(params)
+    assert ('parameter', 'average') == state.values.sequential.dense0.kernel._fields
+    assert np.array_equal(params.sequential.dense0.kernel,
+                          opt.get_parameters(state, averaged=True).sequential.dense0.kernel)
+
+    state = opt.update(loss_with_parameters.apply, state, inputs, targets, jit=jit)
+    kernel = opt.get_parameters(state).sequential.dense0.kernel
+    average = opt.get_parameters(state, averaged=True).sequential.dense0.kernel
+    assert np.allclose(.5 * params.sequential.dense0.kernel + .5 * kernel, average)
+
+    out = loss_with_parameters.apply_from(
+        {loss_with_parameters: opt.get_parameters(state, averaged=True)}, inputs, targets,
+        jit=jit)
+    assert () == out.shape
+
+    with pytest.raises(ValueError):
+        Sgd().get_parameters(Sgd().init(params), averaged=True)
+
+
+@pytest.mark.parametrize('jit', (False, True))
+def test_KFac(jit):
+    @parametrized
+    def loss(inputs, targets):
+        hidden = Sequential(Conv(2, (3, 3)), relu, flatten)(inputs)
+        return -np.mean(Sequential(Dense(4), relu, Dense(4), log_softmax)(hidden) * targets)
+
+    inputs, targets = random_inputs((3, 5, 5, 1)), np.eye(4)[np.array([0, 1, 2])]
+    params = loss.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt = KFac(.1, inverse_update_period=2)
+    state = opt.init(params)
+    dense_state = state.values.sequential1.dense0
+    assert ('parameter', 'a_factor', 'g_factor', 'a_inverse', 'g_inverse') == \
+           dense_state.kernel._fields
+    assert (18 + 1, 18 + 1) == dense_state.kernel.a_factor.shape
+    assert (4, 4) == dense_state.kernel.g_factor.shape
+    assert ('parameter', 'm', 'v') == state.values.sequential0.conv.kernel._fields
+
+    initial_loss = loss.apply(params, inputs, targets)
+    for _ in range(3):
+        state, l = opt.update_and_get_loss(loss.apply, state, inputs, targets, jit=jit)
+
+    assert 3 == opt.get_step(state)
+    assert l < initial_loss
+    dense_state = state.values.sequential1.dense0
+    assert not np.allclose(np.eye(19), dense_state.kernel.a_factor)
+    assert not np.allclose(np.eye(19), dense_state.kernel.a_inverse)
+
+
+def test_KFac_nested_apply():
+    loss = L2Regularized(loss_with_parameters, .01)
+    inputs, targets = random_inputs((3, 10)), np.eye(4)[np.array([0, 1, 2])]
+    params = loss.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt = KFac(.1)
+    state = opt.update(loss.apply, opt.init(params), inputs, targets)
+    dense_state = state.values.model.sequential.dense0
+    assert not np.allclose(np.eye(11), dense_state.kernel.a_factor)
+
+
+@pytest.mark.parametrize('jit', (False, True))
+def test_KFac_scan(jit):
+    @parametrized
+    def loss(inputs, targets):
+        dense = Dense(3)
+        _, hidden = lax.scan(lambda carry, x: (carry, relu(dense(x))), None, inputs)
+        return np.mean((Dense(2)(hidden) - targets) ** 2)
+
+    inputs, targets = random_inputs((4, 2, 3)), random_inputs((4, 2, 2))
+    params = loss.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt = KFac(.1)
+    state = opt.init(params)
+    initial_loss = loss.apply(params, inputs, targets)
+    for _ in range(3):
+        state, l = opt.update_and_get_loss(loss.apply, state, inputs, targets, jit=jit)
+
+    assert l < initial_loss
+    assert ('parameter', 'm', 'v') == state.values.dense0.kernel._fields
+    dense_state = state.values.dense1
+    assert not np.allclose(np.eye(4), dense_state.kernel.a_factor)
+
+
+@pytest.mark.parametrize('jit', (False, True))
+@pytest.mark.parametrize('remat', (False, True))
+def test_update_truncated(jit, remat):
+    rnn = Rnn(*GRUCell(3, zeros), return_carry=True)
+
+    @parametrized
+    def loss(carry, inputs, targets):
+        outputs, carry = rnn(inputs, carry)
+        return np.mean((Dense(2)(outputs) - targets) ** 2), carry
+
+    inputs, targets = random_inputs((2, 10, 4)), random_inputs((2, 10, 2))
+    carry = rnn.carry_init(2)
+    params = loss.init_parameters(carry, inputs, targets, key=PRNGKey(0))
+
+    opt = Sgd(0.)
+    state, losses, final_carry = opt.update_truncated(
+        loss.apply, opt.init(params), carry, inputs, targets, window_length=4, jit=jit, remat=remat)
+    assert 3 == opt.get_step(state)
+    assert (3,) == losses.shape
+    _, expected_carry = loss.apply(params, carry, inputs, targets)
+    assert np.allclose(expected_carry, final_carry, atol=1e-6)
+
+    opt = Adam()
+    state = opt.init(params)
+    for _ in range(3):
+        state, losses, _ = opt.update_truncated(
+            loss.apply, state, carry, inputs, targets, window_length=4, jit=jit, remat=remat)
+    assert 9 == opt.get_step(state)
+    final_loss, _ = loss.apply(opt.get_parameters(state), carry, inputs, targets)
+    initial_loss, _ = loss.apply(params, carry, inputs, targets)
+    assert final_loss < initial_loss
+
+
+def test_update_truncated_wrapped():
+    rnn = Rnn(*GRUCell(3, zeros), return_carry=True)
+
+    @parametrized
+    def loss(carry, inputs, targets):
+        outputs, carry = rnn(inputs, carry)
+        return np.mean((Dense(2)(outputs) - targets) ** 2), carry
+
+    inputs, targets = random_inputs((2, 10, 4)), random_inputs((2, 10, 2))
+    carry = rnn.carry_init(2)
+    params = loss.init_parameters(carry, inputs, targets, key=PRNGKey(0))
+
+    opt = Clipped(Grouped(Sgd(1.), {'rnn': None}), max_global_norm=1e-3)
+    state, _, _ = opt.update_truncated(loss.apply, opt.init(params), carry, inputs, targets,
+                                       window_length=5)
+    new_params = opt.get_parameters(state)
+    assert_parameters_equal(params.rnn, new_params.rnn)
+    update = tree_multimap(lambda new, old: new - old, new_params.dense, params.dense)
+    assert 0 < optimizers.experimental.l2_norm(update) <= 2e-3 + 1e-6
+
+    for opt in (Sweep(Sgd, step_size=[.1, .2]), KFac()):
+        with pytest.raises(NotImplementedError):
+            opt.update_truncated(loss.apply, opt.init(params), carry, inputs, targets,
+                                 window_length=5)